@@ -0,0 +1,556 @@
+"""
+archive.py
+
+Formats for saving the lab files fetched by a run to {save_dir}raw/, so that
+a later run can re-render them without connecting to GitHub (cf. --offline).
+
+    pack   : every lab file in one append-only file (labs.pack), with an
+             index (labs.json) of where each student's lab file is
+    gz     : one gzip file per student
+    zst    : one zstd file per student (needs the zstandard package)
+    lz4    : one lz4 file per student (needs the lz4 package)
+    pklbz2 : one pickled, bz2-compressed file per student (as util.save_files
+             writes them)
+
+Only the pklbz2 format runs pickle when loading.
+"""
+import gzip
+import json
+import mmap
+import os
+import struct
+from collections.abc import Mapping
+
+import cache
+import util
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+
+FORMATS = ("pack", "gz", "zst", "lz4", "pklbz2")
+
+EXTENSIONS = {
+    "gz": ".ipynb.gz",
+    "zst": ".ipynb.zst",
+    "lz4": ".ipynb.lz4",
+    "pklbz2": ".pkl.bz2",
+}
+
+DEFAULT_LEVELS = {"gz": 6, "zst": 3, "lz4": 0}
+
+
+def compress(fmt, data, level=None):
+    """
+    compress(fmt, data, level=None)
+
+    Returns data compressed in the format fmt ('gz', 'zst' or 'lz4') at the
+    given compression level (default: DEFAULT_LEVELS[fmt]).
+    """
+    if level is None:
+        level = DEFAULT_LEVELS[fmt]
+    if fmt == "gz":
+        return gzip.compress(data, compresslevel=level)
+    if fmt == "zst":
+        _require(zstandard, "zstandard")
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    if fmt == "lz4":
+        _require(lz4, "lz4")
+        return lz4.frame.compress(data, compression_level=level)
+    raise ValueError(f"Unknown compression format {fmt}")
+
+
+def decompress(fmt, data):
+    """
+    decompress(fmt, data)
+
+    Returns data (compressed by compress(fmt, ...)) decompressed.
+    """
+    if fmt == "gz":
+        return gzip.decompress(data)
+    if fmt == "zst":
+        _require(zstandard, "zstandard")
+        return zstandard.ZstdDecompressor().decompress(data)
+    if fmt == "lz4":
+        _require(lz4, "lz4")
+        return lz4.frame.decompress(data)
+    raise ValueError(f"Unknown compression format {fmt}")
+
+
+def _require(module, name):
+    if module is None:
+        raise ImportError(
+            f"The {name} package is needed for this archive format "
+            f"(e.g., pip install {name})."
+        )
+
+
+class FileArchive:
+    """
+    FileArchive(raw_dir, fmt="gz", level=None)
+
+    Saves each student's lab file to its own file, {raw_dir}{gid}{extension},
+    compressed in the format fmt (cf. EXTENSIONS).
+
+    Inputs
+    ------
+    raw_dir : str
+        (e.g., ./DSCI571/Lab4/raw/)
+    fmt : str
+        'gz', 'zst', 'lz4' or 'pklbz2'
+    level : int or None
+        Compression level (ignored for pklbz2). Default: DEFAULT_LEVELS[fmt]
+    """
+
+    def __init__(self, raw_dir, fmt="gz", level=None):
+        if fmt not in EXTENSIONS:
+            raise ValueError(f"Unknown archive format {fmt}")
+        self.raw_dir = raw_dir
+        self.fmt = fmt
+        self.level = level
+        if not os.path.exists(raw_dir):
+            os.makedirs(raw_dir)
+
+    def __repr__(self):
+        return f"FileArchive({self.raw_dir!r}, fmt={self.fmt!r})"
+
+    def fname(self, key):
+        return self.raw_dir + key + EXTENSIONS[self.fmt]
+
+    def __contains__(self, key):
+        return os.path.exists(self.fname(key))
+
+    def keys(self):
+        extension = EXTENSIONS[self.fmt]
+        return sorted(
+            x[: -len(extension)]
+            for x in os.listdir(self.raw_dir)
+            if x.endswith(extension)
+        )
+
+    def get(self, key):
+        """
+        get(key)
+
+        Returns the lab file saved for key, or None if there isn't one.
+        """
+        if key not in self:
+            return None
+        if self.fmt == "pklbz2":
+            return util.load_pklbz2(self.fname(key))
+        with open(self.fname(key), "rb") as fp:
+            return decompress(self.fmt, fp.read())
+
+    def put(self, key, data):
+        """
+        put(key, data)
+
+        Saves data (bytes) as the lab file for key.
+        """
+        if self.fmt == "pklbz2":
+            util.to_pklbz2(self.fname(key), data)
+        else:
+            util.atomic_write(
+                self.fname(key), compress(self.fmt, data, self.level)
+            )
+        return
+
+    def close(self):
+        return
+
+
+class PackArchive:
+    """
+    PackArchive(raw_dir)
+
+    Saves every student's lab file to a single append-only file,
+    {raw_dir}labs.pack, as a sequence of records:
+
+        key length (2 bytes), data length (8 bytes), key, data
+
+    The offset, length and git blob SHA of each key's data are kept in an
+    index, {raw_dir}labs.json, so that any one lab file can be read without
+    reading the others. The index is written by close(); records appended
+    after the index was last written (e.g., by an interrupted run) are found
+    by scanning the end of the pack. Saving a key again with the same data
+    does nothing; with new data, it appends a new record, which supersedes
+    the old one, and close() compacts the pack once superseded records take
+    up more than a quarter of it.
+
+    Inputs
+    ------
+    raw_dir : str
+        (e.g., ./DSCI571/Lab4/raw/)
+    """
+
+    RECORD = struct.Struct(">HQ")
+
+    # Fraction of the pack that superseded records may take up before
+    # close() compacts it
+    MAX_GARBAGE = 0.25
+
+    def __init__(self, raw_dir):
+        self.raw_dir = raw_dir
+        self.pack_fname = raw_dir + "labs.pack"
+        self.index_fname = raw_dir + "labs.json"
+        if not os.path.exists(raw_dir):
+            os.makedirs(raw_dir)
+        self.index = {}
+        self.size = 0
+        if os.path.exists(self.index_fname):
+            with open(self.index_fname, "r") as fp:
+                saved = json.load(fp)
+            # (indexes written before SHAs were recorded have none)
+            self.index = {
+                k: tuple(v) + (None,) * (3 - len(v))
+                for k, v in saved["labs"].items()
+            }
+            self.size = saved["size"]
+        if self.size > self._pack_size():
+            # the pack was compacted after the index was written: re-index it
+            self.index = {}
+            self.size = 0
+        self._scan()
+
+    def __repr__(self):
+        return f"PackArchive({self.raw_dir!r})"
+
+    def _pack_size(self):
+        if not os.path.exists(self.pack_fname):
+            return 0
+        return os.path.getsize(self.pack_fname)
+
+    def _scan(self):
+        # Index the records after self.size (a truncated record is ignored)
+        if not os.path.exists(self.pack_fname):
+            return
+        end = os.path.getsize(self.pack_fname)
+        with open(self.pack_fname, "rb") as fp:
+            fp.seek(self.size)
+            while self.size + self.RECORD.size <= end:
+                key_len, data_len = self.RECORD.unpack(
+                    fp.read(self.RECORD.size)
+                )
+                offset = self.size + self.RECORD.size + key_len
+                if offset + data_len > end:
+                    break
+                key = fp.read(key_len).decode("utf-8")
+                self.index[key] = (offset, data_len, None)
+                fp.seek(data_len, os.SEEK_CUR)
+                self.size = offset + data_len
+        return
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def keys(self):
+        return sorted(self.index)
+
+    def get(self, key):
+        """
+        get(key)
+
+        Returns the lab file saved for key, or None if there isn't one.
+        """
+        if key not in self.index:
+            return None
+        offset, length, _ = self.index[key]
+        with open(self.pack_fname, "rb") as fp:
+            fp.seek(offset)
+            return fp.read(length)
+
+    def put(self, key, data):
+        """
+        put(key, data)
+
+        Appends data (bytes) as the lab file for key, unless it is already
+        the lab file saved for key.
+        """
+        sha = cache.git_blob_sha(data)
+        if key in self.index:
+            _, length, saved_sha = self.index[key]
+            if length == len(data):
+                if saved_sha is None:
+                    saved_sha = cache.git_blob_sha(self.get(key))
+                if saved_sha == sha:
+                    self.index[key] = self.index[key][:2] + (sha,)
+                    return
+        key_bytes = key.encode("utf-8")
+        header = self.RECORD.pack(len(key_bytes), len(data))
+        with open(self.pack_fname, "ab") as fp:
+            fp.seek(self.size)
+            fp.truncate()
+            fp.write(header + key_bytes)
+            fp.write(data)
+        offset = self.size + len(header) + len(key_bytes)
+        self.index[key] = (offset, len(data), sha)
+        self.size = offset + len(data)
+        return
+
+    def garbage(self):
+        """
+        garbage()
+
+        Returns the number of bytes of the pack taken up by superseded
+        records.
+        """
+        live = sum(
+            self.RECORD.size + len(key.encode("utf-8")) + length
+            for key, (_, length, _) in self.index.items()
+        )
+        return self.size - live
+
+    def compact(self):
+        """
+        compact()
+
+        Rewrites the pack with only the latest record of each key. If the
+        index can't be written afterwards, the next PackArchive re-indexes
+        the pack (which is then smaller than the index says).
+        """
+        tmp_fname = self.pack_fname + ".tmp"
+        index = {}
+        size = 0
+        with open(self.pack_fname, "rb") as src:
+            with open(tmp_fname, "wb") as dst:
+                for key, (offset, length, sha) in self.index.items():
+                    src.seek(offset)
+                    key_bytes = key.encode("utf-8")
+                    header = self.RECORD.pack(len(key_bytes), length)
+                    dst.write(header + key_bytes)
+                    dst.write(src.read(length))
+                    offset = size + len(header) + len(key_bytes)
+                    index[key] = (offset, length, sha)
+                    size = offset + length
+        os.replace(tmp_fname, self.pack_fname)
+        self.index = index
+        self.size = size
+        return
+
+    def close(self):
+        """
+        close()
+
+        Compacts the pack if needed (cf. MAX_GARBAGE), and writes the index.
+        """
+        if self.garbage() > self.MAX_GARBAGE * self.size:
+            self.compact()
+        index = {"size": self.size, "labs": self.index}
+        util.atomic_write(self.index_fname, json.dumps(index, indent=1))
+        return
+
+
+class MappedArchive(Mapping):
+    """
+    MappedArchive(save_dir)
+
+    A read-only view of the lab files in the pack archive {save_dir}raw/
+    (cf. PackArchive), which behaves like the lab_files dict of load_files.
+    The pack is memory-mapped, and a student's lab file is only read when it
+    is looked up, so that writing a page only holds that page's lab files in
+    memory, however many students are in the pack.
+
+    Inputs
+    ------
+    save_dir : str
+        (e.g., ./DSCI571/Lab4/)
+    """
+
+    def __init__(self, save_dir):
+        pack = PackArchive(save_dir + "raw/")
+        self.raw_dir = pack.raw_dir
+        self.index = pack.index
+        # (None for records appended after the index was written)
+        self.shas = {key: sha for key, (_, _, sha) in self.index.items()}
+        self._mmap = None
+        if pack.size > 0:
+            with open(pack.pack_fname, "rb") as fp:
+                self._mmap = mmap.mmap(
+                    fp.fileno(), pack.size, access=mmap.ACCESS_READ
+                )
+
+    def __repr__(self):
+        return f"MappedArchive({self.raw_dir!r}, {len(self)} lab files)"
+
+    def __getitem__(self, key):
+        offset, length, _ = self.index[key]
+        return self._mmap[offset : offset + length]
+
+    def __contains__(self, key):
+        # (without copying the lab file, as Mapping's would)
+        return key in self.index
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.index)
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+        return
+
+
+def detect_format(raw_dir):
+    """
+    detect_format(raw_dir)
+
+    Returns the format of the lab files in raw_dir ('pack' if there are none).
+    """
+    if not os.path.exists(raw_dir):
+        return "pack"
+    fnames = os.listdir(raw_dir)
+    if ("labs.pack" in fnames) or ("labs.json" in fnames):
+        return "pack"
+    for fmt, extension in EXTENSIONS.items():
+        if any(x.endswith(extension) for x in fnames):
+            return fmt
+    return "pack"
+
+
+def open_archive(save_dir, fmt=None, level=None):
+    """
+    open_archive(save_dir, fmt=None, level=None)
+
+    Returns the archive of lab files in {save_dir}raw/.
+
+    Inputs
+    ------
+    save_dir : str
+        (e.g., ./DSCI571/Lab4/)
+    fmt : str or None
+        One of FORMATS. Default: the format of the files already there (cf.
+        detect_format)
+    level : int or None
+        Compression level, for the gz, zst and lz4 formats.
+    """
+    raw_dir = save_dir + "raw/"
+    if fmt is None:
+        fmt = detect_format(raw_dir)
+    if fmt == "pack":
+        return PackArchive(raw_dir)
+    return FileArchive(raw_dir, fmt, level)
+
+
+def save_files(save_dir, obj_dict, fmt="pack", level=None):
+    """
+    save_files(save_dir, obj_dict, fmt="pack", level=None)
+
+    Saves each lab file of obj_dict (keyed by GitHub ID) to {save_dir}raw/,
+    in the format fmt (cf. open_archive).
+    """
+    archive = open_archive(save_dir, fmt, level)
+    for key, byte_string in obj_dict.items():
+        archive.put(key, byte_string)
+    archive.close()
+    print(f"Saved values of obj_dict to {archive.raw_dir} ({fmt}).")
+    return
+
+
+def save_stream(save_dir, obj_stream, fmt="pack", level=None):
+    """
+    save_stream(save_dir, obj_stream, fmt="pack", level=None)
+
+    Saves each (key, obj) pair of obj_stream like save_files does, as it
+    passes through, and yields it on. Pairs whose obj is None are not saved.
+
+    Inputs
+    ------
+    save_dir : str
+    obj_stream : iterable of tuples
+        (e.g., output of stream_lab_files)
+    fmt : str
+    level : int or None
+    """
+    archive = open_archive(save_dir, fmt, level)
+    try:
+        for key, byte_string in obj_stream:
+            if byte_string is not None:
+                archive.put(key, byte_string)
+            yield key, byte_string
+    finally:
+        archive.close()
+    print(f"Saved values of obj_stream to {archive.raw_dir} ({fmt}).")
+    return
+
+
+def load_files(save_dir, keys=None, fmt=None):
+    """
+    load_files(save_dir, keys=None, fmt=None)
+
+    Loads the lab files previously written by save_files(save_dir, ...).
+
+    Inputs
+    ------
+    save_dir : str
+        (e.g., ./DSCI571/Lab4/)
+    keys : array or None
+        The GitHub IDs to load. Default: every lab file in {save_dir}raw/
+    fmt : str or None
+        Default: the format of the files there (cf. detect_format)
+
+    Returns
+    -------
+    obj_dict : dict
+        keys matching those found, in the order given by keys.
+    """
+    archive = open_archive(save_dir, fmt)
+    if keys is None:
+        keys = archive.keys()
+    obj_dict = {}
+    missing_keys = []
+    for key in keys:
+        byte_string = archive.get(key)
+        if byte_string is not None:
+            obj_dict[key] = byte_string
+        else:
+            missing_keys.append(key)
+    print(f"Loaded {len(obj_dict)} files from {archive.raw_dir}.")
+    if len(missing_keys) > 0:
+        print(f"Not found in {archive.raw_dir}: {missing_keys}")
+    return obj_dict
+
+
+def map_files(save_dir, keys=None, fmt=None):
+    """
+    map_files(save_dir, keys=None, fmt=None)
+
+    Like load_files, but if the lab files in {save_dir}raw/ are in a pack,
+    returns a MappedArchive of them instead, which only reads a lab file when
+    it is looked up.
+
+    Inputs
+    ------
+    save_dir : str
+        (e.g., ./DSCI571/Lab4/)
+    keys : array or None
+        The GitHub IDs that will be looked up (only used to report those
+        that are missing).
+    fmt : str or None
+        Default: the format of the files there (cf. detect_format). Pass the
+        format they were just saved in, as files of an earlier run in another
+        format may also be there.
+
+    Returns
+    -------
+    lab_files : MappedArchive or dict
+    """
+    if fmt is None:
+        fmt = detect_format(save_dir + "raw/")
+    if fmt != "pack":
+        return load_files(save_dir, keys, fmt)
+    lab_files = MappedArchive(save_dir)
+    print(f"Mapped {len(lab_files)} files from {lab_files.raw_dir}.")
+    if keys is not None:
+        missing_keys = [key for key in keys if key not in lab_files]
+        if len(missing_keys) > 0:
+            print(f"Not found in {lab_files.raw_dir}: {missing_keys}")
+    return lab_files
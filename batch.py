@@ -0,0 +1,162 @@
+"""
+batch.py
+
+Job specs for --batch: several outputs, each a (course, lab, exercises,
+sections) tuple, run as one job. Each lab's notebooks are fetched once, and
+each student's notebook is parsed once for all of that lab's exercises (cf.
+run_lab in write_exercise_to_html.py).
+
+A job spec is a JSON file (or a YAML file, if PyYAML is installed) such as
+
+    {
+        "gidpath": "classy.csv",
+        "studentsperpage": 20,
+        "outputs": [
+            {"course": 571, "lab": 4, "exercises": [3, 4, [5, 6]]},
+            {"course": 571, "lab": 5, "exercises": [1, 2],
+             "sections": ["L01", "L02"]}
+        ]
+    }
+
+Each entry of "exercises" is an exercise number, or a list of them to write
+to the same pages. "sections", "assignments" and "ta" are optional (cf. the
+flags --section, --assignments and --ta). Any flag of the main script may be
+set for the whole job at the top level, including "course", "lab", "section",
+"assignments" and "ta" as defaults for the outputs; flags passed on the
+command line take precedence.
+"""
+import json
+
+import util
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+
+# The keys of an output, and the flags they default to
+OUTPUT_KEYS = {
+    "course": "course",
+    "lab": "lab",
+    "exercises": None,
+    "sections": "section",
+    "assignments": "assignments",
+    "ta": "ta",
+}
+
+
+def load_job(fname):
+    """
+    load_job(fname)
+
+    Loads the job spec in fname (cf. the module's docstring).
+
+    Returns
+    -------
+    settings : dict
+        Flags set for the whole job, by name (e.g., {"studentsperpage": 20})
+    outputs : list of dicts
+        With keys "course", "lab", "exercises", "sections", "assignments"
+        and "ta" (cf. normalize_output)
+    """
+    with open(fname, "r") as fp:
+        if fname.endswith((".yaml", ".yml")):
+            if yaml is None:
+                raise ImportError(
+                    "The PyYAML package is needed for YAML job specs "
+                    "(e.g., pip install pyyaml); or use JSON."
+                )
+            spec = yaml.safe_load(fp)
+        else:
+            spec = json.load(fp)
+    if not isinstance(spec, dict) or "outputs" not in spec:
+        raise ValueError(f"Expected a dict with 'outputs' in {fname}.")
+    settings = {key: value for key, value in spec.items() if key != "outputs"}
+    flags = vars(util.parser.parse_args([]))
+    unknown = [key for key in settings if key not in flags or key == "batch"]
+    if len(unknown) > 0:
+        raise ValueError(f"Unknown setting(s) {unknown} in {fname}.")
+    outputs = []
+    for output in spec["outputs"]:
+        unknown = [key for key in output if key not in OUTPUT_KEYS]
+        if len(unknown) > 0:
+            raise ValueError(f"Unknown key(s) {unknown} in output {output}.")
+        for key, flag in OUTPUT_KEYS.items():
+            if key not in output and flag in settings:
+                output[key] = settings[flag]
+        outputs.append(normalize_output(output))
+    return settings, outputs
+
+
+def output_from_args(args):
+    """
+    output_from_args(args)
+
+    Returns the output of a single run (i.e., without --batch), from the
+    flags in args (the output of util.parser.parse_args).
+    """
+    return normalize_output(
+        {
+            "course": args.course,
+            "lab": args.lab,
+            "exercises": [args.exercise],
+            "sections": args.section,
+            "assignments": args.assignments,
+            "ta": args.ta,
+        }
+    )
+
+
+def normalize_output(output):
+    """
+    normalize_output(output)
+
+    Returns output (a dict) with every key of OUTPUT_KEYS: course and lab as
+    strings (as they are passed on the command line), each exercise as an
+    int or a list of ints (as write_pages takes them), and sections and ta
+    as lists (or None).
+    """
+    for key in ("course", "lab", "exercises"):
+        if output.get(key) is None:
+            raise ValueError(f"Expected '{key}' in output {output}.")
+    exercises = []
+    for exercise_num in output["exercises"]:
+        if isinstance(exercise_num, (list, tuple)):
+            exercise_num = [int(x) for x in exercise_num]
+            if len(exercise_num) == 0:
+                raise ValueError("exercise_num is mandatory")
+            elif len(exercise_num) == 1:
+                exercise_num = exercise_num[0]
+        else:
+            exercise_num = int(exercise_num)
+        if exercise_num not in exercises:
+            exercises.append(exercise_num)
+    if len(exercises) == 0:
+        raise ValueError("exercise_num is mandatory")
+    normalized = {
+        "course": f"{output['course']}",
+        "lab": f"{output['lab']}",
+        "exercises": exercises,
+        "assignments": output.get("assignments"),
+    }
+    for key in ("sections", "ta"):
+        value = output.get(key)
+        if isinstance(value, str):
+            value = [value]
+        normalized[key] = value
+    return normalized
+
+
+def group_by_lab(outputs):
+    """
+    group_by_lab(outputs)
+
+    Returns outputs grouped by lab, as a dict of lists keyed by
+    (course, lab), in order of first appearance.
+    """
+    labs = {}
+    for output in outputs:
+        key = (output["course"], output["lab"])
+        labs.setdefault(key, []).append(output)
+    return labs
@@ -0,0 +1,873 @@
+"""
+benchmark.py
+
+Times fetching, slicing and rendering the lab files of a synthetic cohort end
+to end, against a local stand-in for the GitHub Enterprise API (so that no
+credentials are needed, and github.ubc.ca isn't hit). For example,
+
+    python3 benchmark.py --students 100 1000 --workers 1 4 8 --latency .05
+
+runs the same pipeline as write_exercise_to_html.py once for each cohort size
+and number of workers, prints where the time went in each run (cf. timing.py)
+and then a comparison of the runs.
+"""
+import base64
+import contextlib
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+import zlib
+from argparse import ArgumentParser
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import nbformat
+import numpy as np
+from github import Github
+
+import archive
+import cache
+import ghapi
+import ratelimit
+import roster
+import timing
+from write_exercise_to_html import (
+    discover_lab_files,
+    make_html_exporter,
+    stream_lab_files,
+    stream_pages_to_files,
+)
+
+
+# The first bytes of every PNG file
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+
+def make_notebook(
+    gid, num_exercises=5, cells_per_exercise=3, image_size=0, revision=0
+):
+    """
+    make_notebook(gid, num_exercises=5, cells_per_exercise=3, image_size=0,
+                  revision=0)
+
+    Returns a synthetic lab file for the student gid: an introduction, then
+    for each exercise a markdown heading ("## Exercise n") followed by
+    cells_per_exercise code cells with printed output and, if image_size is
+    positive, a code cell with an embedded PNG output.
+
+    Inputs
+    ------
+    gid : str
+    num_exercises : int
+    cells_per_exercise : int
+    image_size : int
+        Number of bytes in each embedded image (random, so that they don't
+        compress, and differ between students). Default: 0 (no images)
+    revision : int
+        Changes the content of the notebook (e.g., to simulate a student
+        pushing again between two runs).
+
+    Returns
+    -------
+    data : bytes
+        The notebook, as JSON (as it would be committed)
+    """
+    rng = np.random.RandomState(zlib.crc32(f"{gid}-{revision}".encode()))
+    cells = [
+        nbformat.v4.new_markdown_cell(
+            f"# Lab\n\nSubmitted by {gid} (revision {revision})."
+        )
+    ]
+    for exercise in range(1, num_exercises + 1):
+        cells.append(
+            nbformat.v4.new_markdown_cell(
+                f"## Exercise {exercise}\n\n"
+                f"rubric={{accuracy:{exercise}}}\n\n"
+                "Explain your answer, with $\\LaTeX$ where needed."
+            )
+        )
+        for cell in range(cells_per_exercise):
+            value = rng.randint(1000)
+            output = nbformat.v4.new_output(
+                "stream", text=f"{gid}: {exercise}.{cell} = {value}\n"
+            )
+            cells.append(
+                nbformat.v4.new_code_cell(
+                    f"x = {value}\nprint('{gid}: {exercise}.{cell} =', x)",
+                    outputs=[output],
+                )
+            )
+        if image_size > 0:
+            png = PNG_SIGNATURE + rng.bytes(image_size - len(PNG_SIGNATURE))
+            output = nbformat.v4.new_output(
+                "display_data",
+                data={
+                    "image/png": base64.b64encode(png).decode("ascii"),
+                    "text/plain": "<Figure size 432x288 with 1 Axes>",
+                },
+            )
+            cells.append(
+                nbformat.v4.new_code_cell("plt.show()", outputs=[output])
+            )
+    notebook = nbformat.v4.new_notebook(cells=cells)
+    return nbformat.writes(notebook).encode("utf-8")
+
+
+def make_cohort(num_students, **kwargs):
+    """
+    make_cohort(num_students, **kwargs)
+
+    Returns a dict of num_students synthetic lab files (cf. make_notebook,
+    which is passed kwargs), keyed by student gid.
+    """
+    return {
+        f"student{k:04d}": make_notebook(f"student{k:04d}", **kwargs)
+        for k in range(num_students)
+    }
+
+
+class FakeGitHub:
+    """
+    FakeGitHub(labs, lab_num, course_num, year_tag="MDS-2019-20",
+               latency=0.0, rate_limit=5000, rate_window=3600)
+
+    A local HTTP server answering the GitHub Enterprise API requests that
+    write_exercise_to_html.py makes (repositories, their contents, blobs,
+    GraphQL lookups), for one lab's student repositories. Each repository
+    holds a README and the student's lab file (lab{lab_num}.ipynb).
+
+    May be used as a context manager, which starts and stops the server.
+
+    Inputs
+    ------
+    labs : dict
+        Lab file (bytes) by student gid
+    lab_num : int
+    course_num : int
+    year_tag : str
+        The organization holding the repositories
+    latency : float
+        Seconds to wait before answering each request.
+    rate_limit : int
+        Number of requests allowed per rate_window seconds. Once they are used
+        up, requests are refused (403, as by GitHub) until the window resets.
+        Conditional requests answered with 304 aren't counted, as on GitHub.
+    rate_window : float
+
+    Attributes
+    ----------
+    base_url : str
+        The server's API URL (once started)
+    requests : Counter
+        Number of requests answered, keyed by (kind, status) (cf.
+        timing.request_kind)
+    """
+
+    def __init__(
+        self,
+        labs,
+        lab_num,
+        course_num,
+        year_tag="MDS-2019-20",
+        latency=0.0,
+        rate_limit=5000,
+        rate_window=3600,
+    ):
+        self.labs = dict(labs)
+        self.lab_num = lab_num
+        self.course_num = course_num
+        self.year_tag = year_tag
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.rate_window = rate_window
+        self.remaining = rate_limit
+        self.reset = time.time() + rate_window
+        self.requests = Counter()
+        self.base_url = None
+        self._versions = Counter()
+        self._server = None
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return (
+            f"FakeGitHub({len(self.labs)} students, latency={self.latency}, "
+            f"rate_limit={self.rate_limit})"
+        )
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+        return False
+
+    def start(self):
+        """
+        start()
+
+        Starts serving (in a background thread), and returns base_url.
+        """
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), _FakeHandler)
+        self._server.daemon_threads = True
+        self._server.fake = self
+        thread = threading.Thread(target=self._server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        port = self._server.server_address[1]
+        self.base_url = f"http://127.0.0.1:{port}/api/v3"
+        return self.base_url
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        return
+
+    def update(self, gid, data):
+        """
+        update(gid, data)
+
+        Replaces the lab file of the student gid (as if they pushed again).
+        """
+        with self._lock:
+            self.labs[gid] = data
+            self._versions[gid] += 1
+        return
+
+    def etag(self, gid):
+        sha = cache.git_blob_sha(self.labs[gid])
+        return f'"{self._versions[gid]}-{sha[:16]}"'
+
+    def use_quota(self):
+        """
+        use_quota()
+
+        Counts a request against the rate limit, and returns whether it is
+        allowed.
+        """
+        with self._lock:
+            now = time.time()
+            if now >= self.reset:
+                self.remaining = self.rate_limit
+                self.reset = now + self.rate_window
+            if self.remaining <= 0:
+                return False
+            self.remaining -= 1
+            return True
+
+    def rate_headers(self):
+        return {
+            "X-RateLimit-Limit": str(self.rate_limit),
+            "X-RateLimit-Remaining": str(self.remaining),
+            "X-RateLimit-Reset": str(int(np.ceil(self.reset))),
+        }
+
+    def gid_of(self, owner, name):
+        # Returns the gid whose repository is owner/name, or None
+        prefix = f"DSCI_{self.course_num}_lab{self.lab_num}_"
+        if owner != self.year_tag or not name.startswith(prefix):
+            return None
+        gid = name[len(prefix) :]
+        return gid if gid in self.labs else None
+
+
+class _FakeHandler(BaseHTTPRequestHandler):
+    # Answers the requests to a FakeGitHub (self.server.fake)
+
+    protocol_version = "HTTP/1.1"
+    repo_path = re.compile(r"/api/v3/repos/([^/]+)/([^/]+)(/.*)?$")
+    graphql_repo = re.compile(
+        r'(\w+): repository\(owner: "([^"]+)", name: "([^"]+)"\)'
+    )
+
+    def log_message(self, *args):
+        return
+
+    def respond(self, status, body=b"", headers=None):
+        fake = self.server.fake
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode("utf-8")
+            content_type = "application/json; charset=utf-8"
+        else:
+            content_type = "application/octet-stream"
+        self.send_response(status)
+        all_headers = {
+            "Content-Type": content_type,
+            "Content-Length": str(len(body)),
+        }
+        all_headers.update(fake.rate_headers())
+        all_headers.update(headers or {})
+        for key, value in all_headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+        with fake._lock:
+            fake.requests[(timing.request_kind(self.path), status)] += 1
+        return
+
+    def refuse(self):
+        # GitHub's answer once the rate limit is used up
+        message = "API rate limit exceeded (benchmark.FakeGitHub)"
+        return self.respond(403, {"message": message})
+
+    def do_GET(self):
+        fake = self.server.fake
+        time.sleep(fake.latency)
+        path = self.path.split("?")[0]
+        if path == "/api/v3/rate_limit":
+            rate = {
+                "limit": fake.rate_limit,
+                "remaining": fake.remaining,
+                "reset": int(fake.reset),
+            }
+            body = {"resources": {"core": rate}, "rate": rate}
+            return self.respond(200, body)
+        match = self.repo_path.match(path)
+        gid = None if match is None else fake.gid_of(*match.groups()[:2])
+        if gid is None:
+            if not fake.use_quota():
+                return self.refuse()
+            return self.respond(404, {"message": "Not Found"})
+        rest = match.group(3) or ""
+        if rest == "":
+            return self.get_repo(gid)
+        if not fake.use_quota():
+            return self.refuse()
+        if rest.rstrip("/") == "/contents":
+            return self.respond(200, self.contents(gid))
+        if rest.startswith("/git/blobs/"):
+            return self.get_blob(gid, rest[len("/git/blobs/") :])
+        return self.respond(404, {"message": "Not Found"})
+
+    def get_repo(self, gid):
+        fake = self.server.fake
+        etag = fake.etag(gid)
+        if self.headers.get("If-None-Match") == etag:
+            return self.respond(304, b"", {"ETag": etag})
+        if not fake.use_quota():
+            return self.refuse()
+        name = f"DSCI_{fake.course_num}_lab{fake.lab_num}_{gid}"
+        full_name = f"{fake.year_tag}/{name}"
+        body = {
+            "id": zlib.crc32(full_name.encode()),
+            "name": name,
+            "full_name": full_name,
+            "url": f"{fake.base_url}/repos/{full_name}",
+            "owner": {"login": fake.year_tag, "type": "Organization"},
+            "private": True,
+            "default_branch": "master",
+        }
+        return self.respond(200, body, {"ETag": etag})
+
+    def contents(self, gid):
+        # The listing of the root of gid's repository
+        fake = self.server.fake
+        name = f"DSCI_{fake.course_num}_lab{fake.lab_num}_{gid}"
+        repo_url = f"{fake.base_url}/repos/{fake.year_tag}/{name}"
+        readme = b"# Lab\n"
+        files = [
+            ("README.md", readme),
+            (f"lab{fake.lab_num}.ipynb", fake.labs[gid]),
+        ]
+        entries = []
+        for fname, data in files:
+            sha = cache.git_blob_sha(data)
+            entries.append(
+                {
+                    "type": "file",
+                    "name": fname,
+                    "path": fname,
+                    "sha": sha,
+                    "size": len(data),
+                    "url": f"{repo_url}/contents/{fname}",
+                    "git_url": f"{repo_url}/git/blobs/{sha}",
+                }
+            )
+        return entries
+
+    def get_blob(self, gid, sha):
+        data = self.server.fake.labs[gid]
+        if sha != cache.git_blob_sha(data):
+            return self.respond(404, {"message": "Not Found"})
+        if "raw" in self.headers.get("Accept", ""):
+            return self.respond(200, data)
+        body = {
+            "sha": sha,
+            "size": len(data),
+            "encoding": "base64",
+            "content": base64.encodebytes(data).decode("ascii"),
+        }
+        return self.respond(200, body)
+
+    def do_POST(self):
+        fake = self.server.fake
+        time.sleep(fake.latency)
+        length = int(self.headers.get("Content-Length", 0))
+        query = json.loads(self.rfile.read(length))["query"]
+        if self.path.split("?")[0] != "/api/graphql":
+            return self.respond(404, {"message": "Not Found"})
+        if not fake.use_quota():
+            return self.refuse()
+        data = {}
+        errors = []
+        for alias, owner, name in self.graphql_repo.findall(query):
+            gid = fake.gid_of(owner, name)
+            if gid is None:
+                data[alias] = None
+                errors.append(
+                    {
+                        "type": "NOT_FOUND",
+                        "path": [alias],
+                        "message": f"Could not resolve to a Repository "
+                        f"with the name '{owner}/{name}'.",
+                    }
+                )
+                continue
+            lab = fake.labs[gid]
+            entries = [
+                {
+                    "name": "README.md",
+                    "type": "blob",
+                    "oid": cache.git_blob_sha(b"# Lab\n"),
+                },
+                {
+                    "name": f"lab{fake.lab_num}.ipynb",
+                    "type": "blob",
+                    "oid": cache.git_blob_sha(lab),
+                },
+            ]
+            data[alias] = {
+                "nameWithOwner": f"{owner}/{name}",
+                "object": {"entries": entries},
+            }
+        body = {"data": data}
+        if len(errors) > 0:
+            body["errors"] = errors
+        return self.respond(200, body)
+
+
+def run_pipeline(
+    fake,
+    gid_list,
+    exercise_num,
+    save_dir,
+    spp=15,
+    num_workers=1,
+    num_jobs=1,
+    discover=False,
+    throttle=False,
+    rate=None,
+    burst=1,
+    adaptive=False,
+    assets=False,
+    fragments=False,
+    archive_fmt="pack",
+    render_cache_size=200,
+    fast=False,
+    verbose=False,
+):
+    """
+    run_pipeline(fake, gid_list, exercise_num, save_dir, spp=15,
+                 num_workers=1, num_jobs=1, discover=False, throttle=False,
+                 rate=None, burst=1, adaptive=False, assets=False,
+                 fragments=False, archive_fmt="pack", render_cache_size=200,
+                 fast=False, verbose=False)
+
+    Fetches, slices and renders the lab files of the students in gid_list
+    from fake (a started FakeGitHub), as write_exercise_to_html.py does
+    from GitHub, writing to save_dir. A second run with the same save_dir
+    re-uses the notebook cache, manifest and render cache of the first.
+
+    Inputs
+    ------
+    fake : FakeGitHub
+    gid_list : list of str
+    exercise_num : int or list of ints
+    save_dir : str
+        (ending in "/")
+    verbose : bool
+        If False, the pipeline's own output is hidden.
+    (cf. the flags of write_exercise_to_html.py for the remaining inputs)
+
+    Returns
+    -------
+    seconds : float
+        The wall time of the run
+    report : timing.RunReport
+        Where the time went
+    """
+    lab_num = fake.lab_num
+    course_num = fake.course_num
+    fname = f".*lab.?{lab_num}.*ipynb"
+    gid_pages = roster.paginate(gid_list, spp)
+    blob_cache = cache.BlobCache(save_dir + "blobs/")
+    render_cache = None
+    if render_cache_size > 0:
+        render_cache = cache.RenderCache(
+            save_dir + "renders/", render_cache_size * 1e6
+        )
+    manifest_fname = save_dir + "manifest.json"
+    manifest = cache.load_manifest(manifest_fname)
+    if rate is not None:
+        throttle = ratelimit.TokenBucket(rate, burst)
+    if adaptive:
+        base = throttle if rate is not None else None
+        throttle = ratelimit.AdaptiveThrottle(base=base)
+
+    report = timing.start()
+    start_time = time.perf_counter()
+    with contextlib.ExitStack() as stack:
+        if not verbose:
+            devnull = stack.enter_context(open(os.devnull, "w"))
+            stack.enter_context(contextlib.redirect_stdout(devnull))
+        pool_size = max(num_workers, 1)
+        gh = Github(
+            login_or_token="benchmark",
+            password="benchmark",
+            base_url=fake.base_url,
+            pool_size=pool_size,
+        )
+        session = ghapi.GitHubSession(
+            "benchmark",
+            "benchmark",
+            fake.base_url,
+            gh,
+            pool_size=pool_size,
+            throttle=throttle,
+        )
+        discovered = None
+        if discover:
+            discovered = discover_lab_files(
+                session,
+                fake.base_url,
+                fname,
+                gid_list,
+                lab_num,
+                course_num,
+                year_tag=fake.year_tag,
+                throttle=throttle,
+            )
+        lab_stream = stream_lab_files(
+            gh,
+            fname,
+            gid_list,
+            lab_num,
+            course_num,
+            year_tag=fake.year_tag,
+            throttle=throttle,
+            num_workers=num_workers,
+            blob_cache=blob_cache,
+            manifest=manifest,
+            discovered=discovered,
+            session=session,
+        )
+        if archive_fmt is not None:
+            lab_stream = archive.save_stream(save_dir, lab_stream, archive_fmt)
+        try:
+            stream_pages_to_files(
+                lab_stream,
+                gid_pages,
+                exercise_num,
+                lab_num,
+                course_num,
+                save_dir=save_dir,
+                html_exporter=make_html_exporter(include_css=False, fast=fast),
+                num_jobs=num_jobs,
+                assets=assets,
+                fragments=fragments,
+                render_cache=render_cache,
+            )
+        finally:
+            cache.save_manifest(manifest_fname, manifest)
+            session.close()
+            if render_cache is not None:
+                render_cache.evict()
+    seconds = time.perf_counter() - start_time
+    timing.stop()
+    return seconds, report
+
+
+parser = ArgumentParser(
+    description=(
+        "Time fetching, slicing and rendering a synthetic cohort's lab files "
+        "against a local stand-in for the GitHub API."
+    )
+)
+parser.add_argument(
+    "--students",
+    default=[100],
+    type=int,
+    nargs="+",
+    help="Cohort size(s) to benchmark (e.g., 10 100 1000).",
+)
+parser.add_argument(
+    "--exercises",
+    default=5,
+    type=int,
+    help="Number of exercises in each notebook.",
+)
+parser.add_argument(
+    "--cells",
+    default=3,
+    type=int,
+    help="Number of code cells in each exercise.",
+)
+parser.add_argument(
+    "--imagesize",
+    default=0,
+    type=int,
+    help=(
+        "Size in bytes of the image embedded in each exercise (0 for no "
+        "images)."
+    ),
+)
+parser.add_argument(
+    "--exercise",
+    default=[1],
+    type=int,
+    nargs="+",
+    help="The exercise(s) to render.",
+)
+parser.add_argument(
+    "--workers",
+    default=[1],
+    type=int,
+    nargs="+",
+    help="Number(s) of workers to benchmark (e.g., 1 4 8).",
+)
+parser.add_argument(
+    "--jobs",
+    default=1,
+    type=int,
+    help="Number of processes used to render the students' answers.",
+)
+parser.add_argument(
+    "--studentsperpage",
+    default=15,
+    type=int,
+    help="Number of students per HTML page.",
+)
+parser.add_argument(
+    "--latency",
+    default=0.0,
+    type=float,
+    help="Seconds the fake server waits before answering each request.",
+)
+parser.add_argument(
+    "--ratelimit",
+    default=5000,
+    type=int,
+    help="Number of requests the fake server allows per --ratewindow.",
+)
+parser.add_argument(
+    "--ratewindow",
+    default=3600,
+    type=float,
+    help="Seconds after which the fake server's rate limit resets.",
+)
+parser.add_argument(
+    "--throttle",
+    default=0,
+    type=float,
+    help="Min duration to wait (in seconds) between pulling lab files.",
+)
+parser.add_argument(
+    "--rate",
+    default=None,
+    type=float,
+    help="Max requests per second, shared by all workers (cf. --throttle).",
+)
+parser.add_argument(
+    "--burst",
+    default=1,
+    type=int,
+    help="Max number of requests made back-to-back under --rate.",
+)
+parser.add_argument(
+    "--adaptive",
+    action="store_true",
+    help="Pace requests by the remaining rate-limit quota.",
+)
+parser.add_argument(
+    "--discover",
+    action="store_true",
+    help="Look up the lab files with batched GraphQL queries.",
+)
+parser.add_argument(
+    "--assets",
+    action="store_true",
+    help="Save output images to assets/ rather than embedding them.",
+)
+parser.add_argument(
+    "--fragments",
+    action="store_true",
+    help="Write one fragment per student and an index page.",
+)
+parser.add_argument(
+    "--archive",
+    default="pack",
+    choices=["pack", "gz", "zst", "lz4", "pklbz2", "none"],
+    help="Format of the saved lab files ('none' to not save them).",
+)
+parser.add_argument(
+    "--rendercache",
+    default=200,
+    type=float,
+    help="Max size (in MB) of the render cache (0 to not use it).",
+)
+parser.add_argument(
+    "--fast",
+    action="store_true",
+    help="Render without nbconvert where possible (cf. fastrender.py).",
+)
+parser.add_argument(
+    "--runs",
+    default=1,
+    type=int,
+    help=(
+        "Number of runs for each configuration. Runs after the first re-use "
+        "the first's cache (as when marking another exercise of a lab)."
+    ),
+)
+parser.add_argument(
+    "--changed",
+    default=0.1,
+    type=float,
+    help="Fraction of students who push again between runs.",
+)
+parser.add_argument(
+    "--verbose",
+    action="store_true",
+    help="Show the pipeline's own output, and each run's report.",
+)
+parser.add_argument(
+    "--out",
+    default=None,
+    help="Save the results of all runs to this JSON file.",
+)
+
+
+def print_results(results):
+    """
+    print_results(results)
+
+    Prints a table comparing the runs in results (cf. __main__).
+    """
+    print("-" * 72)
+    print(
+        f"{'students':>8}{'workers':>8}{'jobs':>6}{'run':>5}{'seconds':>10}"
+        f"{'students/s':>12}{'requests':>10}{'refused':>9}"
+    )
+    for result in results:
+        print(
+            f"{result['students']:>8}{result['workers']:>8}"
+            f"{result['jobs']:>6}{result['run']:>5}"
+            f"{result['seconds']:>10.2f}"
+            f"{result['students'] / result['seconds']:>12.1f}"
+            f"{result['requests']:>10}{result['refused']:>9}"
+        )
+    print("-" * 72)
+    return
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+
+    exercise_num = args.exercise
+    if len(exercise_num) == 1:
+        exercise_num = exercise_num[0]
+    archive_fmt = None if args.archive == "none" else args.archive
+    rng = np.random.RandomState(0)
+
+    results = []
+    for num_students in args.students:
+        print(f"Generating {num_students} notebooks...")
+        labs = make_cohort(
+            num_students,
+            num_exercises=args.exercises,
+            cells_per_exercise=args.cells,
+            image_size=args.imagesize,
+        )
+        gid_list = list(labs)
+        size = sum(len(lab) for lab in labs.values())
+        print(f"\t{size / 1e6:.1f} MB in total")
+        for num_workers in args.workers:
+            fake = FakeGitHub(
+                labs,
+                lab_num=1,
+                course_num=571,
+                latency=args.latency,
+                rate_limit=args.ratelimit,
+                rate_window=args.ratewindow,
+            )
+            with fake, tempfile.TemporaryDirectory() as tmp_dir:
+                for run in range(1, args.runs + 1):
+                    if run > 1:
+                        num_changed = int(round(args.changed * num_students))
+                        for gid in rng.choice(
+                            gid_list, num_changed, replace=False
+                        ):
+                            fake.update(
+                                gid,
+                                make_notebook(
+                                    gid,
+                                    num_exercises=args.exercises,
+                                    cells_per_exercise=args.cells,
+                                    image_size=args.imagesize,
+                                    revision=run,
+                                ),
+                            )
+                    requests_before = Counter(fake.requests)
+                    print(
+                        f"{num_students} students, {num_workers} workers, "
+                        f"run {run}..."
+                    )
+                    seconds, report = run_pipeline(
+                        fake,
+                        gid_list,
+                        exercise_num,
+                        tmp_dir + "/",
+                        spp=args.studentsperpage,
+                        num_workers=num_workers,
+                        num_jobs=args.jobs,
+                        discover=args.discover,
+                        throttle=args.throttle,
+                        rate=args.rate,
+                        burst=args.burst,
+                        adaptive=args.adaptive,
+                        assets=args.assets,
+                        fragments=args.fragments,
+                        archive_fmt=archive_fmt,
+                        render_cache_size=args.rendercache,
+                        fast=args.fast,
+                        verbose=args.verbose,
+                    )
+                    requests = fake.requests - requests_before
+                    if args.verbose:
+                        report.print_summary()
+                    results.append(
+                        {
+                            "students": num_students,
+                            "workers": num_workers,
+                            "jobs": args.jobs,
+                            "run": run,
+                            "seconds": seconds,
+                            "requests": sum(requests.values()),
+                            "refused": sum(
+                                n
+                                for (kind, status), n in requests.items()
+                                if status == 403
+                            ),
+                            "summary": report.summary(),
+                        }
+                    )
+    print_results(results)
+    if args.out is not None:
+        with open(args.out, "w") as fp:
+            json.dump({"args": vars(args), "results": results}, fp, indent=1)
+        print(f"Wrote results to {args.out}")
@@ -0,0 +1,323 @@
+"""
+cache.py
+
+On-disk caches that let a re-run skip work that an earlier run already did.
+"""
+import hashlib
+import json
+import os
+from collections.abc import Mapping
+
+import util
+
+
+def git_blob_sha(data):
+    """
+    git_blob_sha(data)
+
+    Returns the SHA-1 that git (and so the GitHub API) uses to name a blob
+    whose content is data.
+
+    Inputs
+    ------
+    data : bytes or str
+    """
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    header = f"blob {len(data)}\0".encode("utf-8")
+    return hashlib.sha1(header + data).hexdigest()
+
+
+def lab_file_sha(lab_files, key):
+    """
+    lab_file_sha(lab_files, key)
+
+    Returns the git blob SHA of the lab file lab_files[key]: as recorded in
+    lab_files.shas, if lab_files records it (e.g., CachedLabFiles or
+    archive.MappedArchive), so that the lab file isn't read just to hash it;
+    otherwise hashed from its content.
+    """
+    sha = getattr(lab_files, "shas", {}).get(key)
+    if sha is None:
+        sha = git_blob_sha(lab_files[key])
+    return sha
+
+
+class BlobCache:
+    """
+    BlobCache(cache_dir)
+
+    A content-addressed store of git blobs. Each blob is saved (uncompressed)
+    to {cache_dir}/{sha[:2]}/{sha[2:]}, where sha is its git blob SHA. Since
+    the GitHub directory listing already reports that SHA, a blob that is in
+    the cache never needs to be downloaded again.
+
+    Inputs
+    ------
+    cache_dir : str
+        (e.g., ./DSCI571/Lab4/blobs/)
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    def __repr__(self):
+        return f"BlobCache({self.cache_dir!r})"
+
+    def path(self, sha):
+        return os.path.join(self.cache_dir, sha[:2], sha[2:])
+
+    def __contains__(self, sha):
+        return os.path.exists(self.path(sha))
+
+    def get(self, sha):
+        """
+        get(sha)
+
+        Returns the content of the blob named sha, or None if it is not in
+        the cache (or if the cached copy does not match sha).
+        """
+        fname = self.path(sha)
+        try:
+            with open(fname, "rb") as fp:
+                data = fp.read()
+        except FileNotFoundError:
+            return None
+        if git_blob_sha(data) != sha:
+            print(f"Warning: discarding corrupt cached blob {sha}")
+            os.remove(fname)
+            return None
+        return data
+
+    def put(self, sha, data):
+        """
+        put(sha, data)
+
+        Saves data to the cache as the blob named sha.
+        """
+        fname = self.path(sha)
+        if os.path.exists(fname):
+            return
+        os.makedirs(os.path.dirname(fname), exist_ok=True)
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        util.atomic_write(fname, data)
+        return
+
+
+def load_manifest(fname):
+    """
+    load_manifest(fname)
+
+    Loads the fetch manifest saved by save_manifest, or returns an empty
+    manifest if there is none yet. The manifest maps each GitHub ID to a
+    record of the last time its lab file was fetched (cf. fetch_lab_file in
+    write_exercise_to_html.py).
+
+    Inputs
+    ------
+    fname : str
+        (e.g., ./DSCI571/Lab4/manifest.json)
+    """
+    if not os.path.exists(fname):
+        return {}
+    with open(fname, "r") as fp:
+        return json.load(fp)
+
+
+def save_manifest(fname, manifest):
+    """
+    save_manifest(fname, manifest)
+
+    Saves manifest (a dict, cf. load_manifest) to fname as JSON.
+    """
+    util.atomic_write(fname, json.dumps(manifest, indent=1, sort_keys=True))
+    return
+
+
+class CachedLabFiles(Mapping):
+    """
+    CachedLabFiles(manifest, blob_cache, keys=None)
+
+    The lab files recorded in manifest, read from blob_cache without
+    connecting to GitHub. A student's lab file is only read when it is looked
+    up, so that writing a page only holds that page's lab files in memory.
+
+    Inputs
+    ------
+    manifest : dict
+        (e.g., output of load_manifest)
+    blob_cache : BlobCache
+    keys : array or None
+        The GitHub IDs to include. Default: every GitHub ID in manifest
+    """
+
+    def __init__(self, manifest, blob_cache, keys=None):
+        if keys is None:
+            keys = sorted(manifest)
+        self.blob_cache = blob_cache
+        self.shas = {}
+        missing_keys = []
+        for key in keys:
+            if key in manifest and manifest[key]["sha"] in blob_cache:
+                self.shas[key] = manifest[key]["sha"]
+            else:
+                missing_keys.append(key)
+        print(f"Found {len(self.shas)} files in {blob_cache.cache_dir}.")
+        if len(missing_keys) > 0:
+            print(f"Not found in {blob_cache.cache_dir}: {missing_keys}")
+
+    def __repr__(self):
+        return f"CachedLabFiles({self.blob_cache!r}, {len(self)} lab files)"
+
+    def __getitem__(self, key):
+        lab = self.blob_cache.get(self.shas[key])
+        if lab is None:
+            raise KeyError(key)
+        return lab
+
+    def __contains__(self, key):
+        # (without reading the lab file, as Mapping's would)
+        return key in self.shas
+
+    def __iter__(self):
+        return iter(self.shas)
+
+    def __len__(self):
+        return len(self.shas)
+
+
+def render_key(blob_sha, exercise_nums, pattern, settings):
+    """
+    render_key(blob_sha, exercise_nums, pattern, settings)
+
+    Returns a hash of everything that the rendering of one student's answer
+    depends on: the blob SHA of their lab file, the exercise numbers, the
+    exercise heading regex and the exporter settings (cf. exporter_settings
+    in write_exercise_to_html.py).
+
+    Inputs
+    ------
+    blob_sha : str
+    exercise_nums : list of int
+    pattern : str or compiled regex
+    settings : dict
+    """
+    inputs = {
+        "blob": blob_sha,
+        "exercises": [int(x) for x in exercise_nums],
+        "pattern": getattr(pattern, "pattern", pattern),
+        "settings": settings,
+    }
+    inputs = json.dumps(inputs, sort_keys=True).encode("utf-8")
+    return hashlib.sha256(inputs).hexdigest()
+
+
+class RenderCache:
+    """
+    RenderCache(cache_dir, max_size=200e6)
+
+    A store of rendered HTML, i.e., of one student's answer to some exercises
+    as exported by nbconvert. Each rendering is saved to
+    {cache_dir}/{key[:2]}/{key[2:]}.html, where key is its render_key, so an
+    answer is only rendered again if the lab file, the exercises or the
+    exporter settings change.
+
+    The cache is bounded in size: evict() removes the least recently used
+    renderings (by modification time, which get() updates) until the cache
+    holds at most max_size bytes.
+
+    Inputs
+    ------
+    cache_dir : str
+        (e.g., ./DSCI571/Lab4/renders/)
+    max_size : float
+        In bytes
+    """
+
+    def __init__(self, cache_dir, max_size=200e6):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    def __repr__(self):
+        return f"RenderCache({self.cache_dir!r}, max_size={self.max_size})"
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key[2:] + ".html")
+
+    def __contains__(self, key):
+        return os.path.exists(self.path(key))
+
+    def get(self, key):
+        """
+        get(key)
+
+        Returns the rendering saved as key, or None if it is not in the
+        cache.
+        """
+        fname = self.path(key)
+        try:
+            with open(fname, "r", encoding="utf-8") as fp:
+                body = fp.read()
+        except FileNotFoundError:
+            return None
+        # (marks it as recently used)
+        os.utime(fname)
+        return body
+
+    def put(self, key, body):
+        """
+        put(key, body)
+
+        Saves body (an HTML string) to the cache as key.
+        """
+        fname = self.path(key)
+        os.makedirs(os.path.dirname(fname), exist_ok=True)
+        util.atomic_write(fname, body.encode("utf-8"))
+        return
+
+    def entries(self):
+        """
+        entries()
+
+        Returns (mtime, size, fname) for each rendering in the cache.
+        """
+        entries = []
+        for subdir in os.scandir(self.cache_dir):
+            if not subdir.is_dir():
+                continue
+            for entry in os.scandir(subdir.path):
+                if entry.name.endswith(".html"):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def evict(self, max_size=None):
+        """
+        evict(max_size=None)
+
+        Removes the least recently used renderings until the cache holds at
+        most max_size (default: self.max_size) bytes, and returns the number
+        removed.
+        """
+        if max_size is None:
+            max_size = self.max_size
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        num_removed = 0
+        for _, size, fname in entries:
+            if total <= max_size:
+                break
+            try:
+                os.remove(fname)
+            except FileNotFoundError:
+                pass
+            total -= size
+            num_removed += 1
+        if num_removed > 0:
+            print(f"Evicted {num_removed} renderings from {self.cache_dir}.")
+        return num_removed
@@ -0,0 +1,363 @@
+"""
+fastrender.py
+
+A fast path for rendering the students' answers (cf. --fast). HTMLExporter
+runs every notebook through nbconvert's preprocessors and Jinja templates,
+but most cells of an exercise are markdown, or short code with text and
+image outputs. FastExporter renders those straight from the notebook's JSON,
+into the same markup as the `basic` template (so the same CSS applies), and
+hands any other cell (e.g., with widgets or JavaScript outputs, raw cells or
+cell magics) to an HTMLExporter, one cell at a time.
+"""
+import html
+import re
+from functools import lru_cache
+
+import nbformat
+from nbconvert.filters.ansi import ansi2html
+from nbconvert.filters.markdown_mistune import (
+    IPythonRenderer,
+    MarkdownWithMath,
+)
+from nbconvert.filters.strings import strip_files_prefix
+from pygments import highlight
+from pygments.formatters import HtmlFormatter
+from pygments.lexers import TextLexer, get_lexer_by_name
+from pygments.util import ClassNotFound
+
+import timing
+
+
+# The version of FastExporter's markup (cf. exporter_settings in
+# write_exercise_to_html.py): change it whenever the markup changes, so that
+# pages and cached renderings made by an earlier version are rewritten
+VERSION = 1
+
+# The output types of HTMLExporter, in order of preference (only the first
+# one an output has is rendered)
+DISPLAY_PRIORITY = [
+    "application/vnd.jupyter.widget-state+json",
+    "application/vnd.jupyter.widget-view+json",
+    "application/javascript",
+    "text/html",
+    "text/markdown",
+    "image/svg+xml",
+    "text/latex",
+    "image/png",
+    "image/jpeg",
+    "text/plain",
+]
+
+# The output types rendered by FastExporter; a cell with an output of any
+# other type is rendered by the HTMLExporter
+FAST_TYPES = {
+    "text/html",
+    "text/markdown",
+    "image/svg+xml",
+    "text/latex",
+    "image/png",
+    "image/jpeg",
+    "text/plain",
+}
+
+# Text followed by a carriage return (and more text on the same line)
+_CARRIAGE_RETURN = re.compile(r".*\r(?=[^\n])")
+
+
+class FastExporter:
+    """
+    FastExporter(html_exporter)
+
+    Renders notebooks as HTMLExporter does (with the `basic` template), but
+    without nbconvert's preprocessors and templates for the cells it can
+    render itself (cf. can_render).
+
+    Inputs
+    ------
+    html_exporter : HTMLExporter
+        Renders the remaining cells (e.g., output of make_html_exporter).
+
+    Attributes
+    ----------
+    fallbacks : int
+        Number of cells rendered by html_exporter so far.
+    """
+
+    def __init__(self, html_exporter):
+        self.html_exporter = html_exporter
+        self.fallbacks = 0
+
+    def __repr__(self):
+        return f"FastExporter({self.fallbacks} cells rendered by nbconvert)"
+
+    def from_notebook_node(self, nb, resources=None):
+        """
+        from_notebook_node(nb, resources=None)
+
+        Returns the html body of the notebook nb and resources (as given, or
+        an empty dict), as HTMLExporter.from_notebook_node does.
+        """
+        language_info = nb.get("metadata", {}).get("language_info", {})
+        language = language_info.get(
+            "pygments_lexer", language_info.get("name")
+        )
+        bodies = []
+        for cell in nb["cells"]:
+            if can_render(cell):
+                bodies.append(render_cell(cell, language or "ipython3"))
+            else:
+                bodies.append(self.render_with_nbconvert(nb, cell))
+        return "\n".join(bodies), {} if resources is None else resources
+
+    def render_with_nbconvert(self, nb, cell):
+        # Renders one cell of nb with the HTMLExporter
+        self.fallbacks += 1
+        with timing.stage("nbconvert"):
+            single = nbformat.NotebookNode({**nb, "cells": [cell]})
+            return self.html_exporter.from_notebook_node(single)[0]
+
+
+def can_render(cell):
+    """
+    can_render(cell)
+
+    Returns whether FastExporter renders the cell itself: a markdown cell, or
+    a code cell without cell magics (e.g., %%R, which nbconvert highlights as
+    another language) whose outputs are streams, errors or data that is
+    rendered as one of FAST_TYPES.
+    """
+    if "transient" in cell:
+        return False
+    if cell["cell_type"] == "markdown":
+        return True
+    if cell["cell_type"] != "code" or cell["source"].startswith("%%"):
+        return False
+    for output in cell.get("outputs", []):
+        if output["output_type"] in ("execute_result", "display_data"):
+            if _data_type(output) not in FAST_TYPES:
+                return False
+        elif output["output_type"] not in ("stream", "error"):
+            return False
+    return True
+
+
+def render_cell(cell, language="ipython3"):
+    """
+    render_cell(cell, language="ipython3")
+
+    Returns the html of cell (cf. can_render), as the `basic` template
+    renders it.
+
+    Inputs
+    ------
+    cell : NotebookNode
+    language : str
+        The name of the pygments lexer for code cells (the notebook's
+        language_info)
+    """
+    if cell["cell_type"] == "markdown":
+        if cell.get("attachments"):
+            renderer = IPythonRenderer(
+                escape=False,
+                attachments=cell["attachments"],
+                anchor_link_text="¶",
+            )
+            markdown = MarkdownWithMath(renderer=renderer).render(
+                cell["source"]
+            )
+        else:
+            markdown = _render_markdown(cell["source"])
+        return (
+            '<div class="cell border-box-sizing text_cell rendered'
+            f'{_celltags(cell)}"><div class="prompt input_prompt">\n'
+            '</div><div class="inner_cell">\n'
+            '<div class="text_cell_render border-box-sizing rendered_html">\n'
+            f"{strip_files_prefix(markdown)}\n"
+            "</div>\n</div>\n</div>"
+        )
+    count = _execution_count(cell)
+    code = _highlight(cell["source"], language)
+    parts = [
+        '<div class="cell border-box-sizing code_cell rendered'
+        f'{_celltags(cell)}">\n<div class="input">\n'
+        f'<div class="prompt input_prompt">In&nbsp;[{count}]:</div>\n'
+        '<div class="inner_cell">\n    <div class="input_area">\n'
+        f"{code}\n    </div>\n</div>\n</div>\n"
+    ]
+    outputs = _coalesce_streams(cell.get("outputs", []))
+    if len(outputs) > 0:
+        parts.append('\n<div class="output_wrapper">\n<div class="output">\n')
+        for output in outputs:
+            if output["output_type"] == "execute_result":
+                prompt = f'<div class="prompt output_prompt">Out[{count}]:'
+            else:
+                prompt = '<div class="prompt">'
+            parts.append(
+                f'\n<div class="output_area">\n\n    {prompt}</div>\n\n'
+                f"{render_output(output, cell)}\n</div>\n"
+            )
+        parts.append("\n</div>\n</div>\n")
+    parts.append("\n</div>")
+    return "".join(parts)
+
+
+def render_output(output, cell):
+    """
+    render_output(output, cell)
+
+    Returns the html of one output of a code cell (without its prompt).
+    """
+    output_type = output["output_type"]
+    if output_type == "stream":
+        return (
+            '<div class="output_subarea output_stream '
+            f'output_{output["name"]} output_text">\n'
+            f"<pre>{ansi2html(output['text'])}</pre>\n</div>"
+        )
+    if output_type == "error":
+        traceback = "".join("\n" + ansi2html(x) for x in output["traceback"])
+        return (
+            '<div class="output_subarea output_text output_error">\n'
+            f"<pre>{traceback}</pre>\n</div>"
+        )
+    extra_class = (
+        "output_execute_result" if output_type == "execute_result" else ""
+    )
+    data_type = _data_type(output)
+    data = output["data"][data_type]
+    if data_type == "text/plain":
+        return (
+            f'<div class="output_text output_subarea {extra_class}">\n'
+            f"<pre>{ansi2html(data)}</pre>\n</div>"
+        )
+    if data_type in ("text/html", "text/markdown"):
+        if data_type == "text/markdown":
+            data = _render_markdown(data)
+        kind = data_type.split("/")[1]
+        return (
+            f'<div class="output_{kind} rendered_html output_subarea '
+            f'{extra_class}">\n{data}\n</div>'
+        )
+    if data_type == "text/latex":
+        return (
+            f'<div class="output_latex output_subarea {extra_class}">\n'
+            f"{data}\n</div>"
+        )
+    if data_type == "image/svg+xml":
+        if output.get("svg_filename"):
+            data = f'<img src="{output["svg_filename"]}">'
+        return (
+            f'<div class="output_svg output_subarea {extra_class}">\n'
+            f"{data}\n</div>"
+        )
+    # image/png or image/jpeg
+    kind = data_type.split("/")[1]
+    filenames = output.get("metadata", {}).get("filenames", {})
+    if data_type in filenames:
+        src = filenames[data_type]
+    else:
+        src = f"data:{data_type};base64,{data}"
+    attributes = [f'<img src="{src}"']
+    for key in ("width", "height"):
+        value = _get_metadata(output, key, data_type)
+        if value is not None:
+            attributes.append(f"{key}={value}")
+    if _get_metadata(output, "unconfined", data_type):
+        attributes.append('class="unconfined"')
+    alt = _get_metadata(output, "alt", data_type)
+    if alt is None:
+        alt = cell.get("metadata", {}).get("alt")
+    if alt is not None:
+        attributes.append(f'alt="{html.escape(f"{alt}")}"')
+    attributes = "\n".join(attributes)
+    return (
+        f'<div class="output_{kind} output_subarea {extra_class}">\n'
+        f"{attributes}\n>\n</div>"
+    )
+
+
+def _data_type(output):
+    # The type of output's data that is rendered, as in the templates'
+    # filter_data_type (None if there is none)
+    data = output.get("data", {})
+    return next((x for x in DISPLAY_PRIORITY if x in data), None)
+
+
+def _get_metadata(output, key, mime):
+    # As nbconvert's get_metadata filter: output.metadata[mime][key], or
+    # else output.metadata[key]
+    metadata = output.get("metadata", {})
+    if mime in metadata and key in metadata[mime]:
+        return metadata[mime][key]
+    return metadata.get(key)
+
+
+def _execution_count(cell):
+    count = cell.get("execution_count")
+    return "&nbsp;" if count is None else f"{count}"
+
+
+def _celltags(cell):
+    tags = cell.get("metadata", {}).get("tags", [])
+    return "".join(f" celltag_{tag}" for tag in tags)
+
+
+def _coalesce_streams(outputs):
+    # Merges consecutive outputs to the same stream and drops text overwritten
+    # by carriage returns, as nbconvert's coalesce_streams does (but without
+    # changing the cell, which may be shared with the parsed lab)
+    merged = []
+    for output in outputs:
+        if (
+            output["output_type"] == "stream"
+            and len(merged) > 0
+            and merged[-1]["output_type"] == "stream"
+            and merged[-1]["name"] == output["name"]
+        ):
+            text = merged[-1]["text"] + output["text"]
+            merged[-1] = {**merged[-1], "text": text}
+        else:
+            merged.append(output)
+    for i, output in enumerate(merged):
+        if output["output_type"] == "stream" and "\r" in output["text"]:
+            text = _CARRIAGE_RETURN.sub("", output["text"])
+            merged[i] = {**output, "text": text}
+    return merged
+
+
+# Questions and starter code are the same in every student's lab file, so
+# their html is kept (by source) and re-used for the next students
+@lru_cache(maxsize=4096)
+def _render_markdown(source):
+    renderer = IPythonRenderer(escape=False, anchor_link_text="¶")
+    return MarkdownWithMath(renderer=renderer).render(source)
+
+
+@lru_cache(maxsize=4096)
+def _highlight(source, language):
+    if len(source) == 0:
+        source = " "
+    return highlight(source, _get_lexer(language), _get_formatter(language))
+
+
+@lru_cache(maxsize=None)
+def _get_lexer(language):
+    # As nbconvert's Highlight2HTML (the IPython lexers if available)
+    if language in ("ipython2", "ipython3"):
+        try:
+            from IPython.lib import lexers
+        except ImportError:
+            language = "python3" if language == "ipython3" else "python"
+        else:
+            if language == "ipython3":
+                return lexers.IPython3Lexer()
+            return lexers.IPythonLexer()
+    try:
+        return get_lexer_by_name(language, stripall=True)
+    except ClassNotFound:
+        return TextLexer()
+
+
+@lru_cache(maxsize=None)
+def _get_formatter(language):
+    return HtmlFormatter(cssclass=" highlight hl-" + language)
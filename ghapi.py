@@ -0,0 +1,253 @@
+"""
+ghapi.py
+
+Direct requests to the GitHub (Enterprise) API, for the lookups that PyGithub
+can only make one repository at a time.
+"""
+import json
+from functools import partial
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import ratelimit
+import timing
+
+
+class GitHubSession(requests.Session):
+    """
+    GitHubSession(uname, password, base_url, gh=None, pool_size=10,
+                  timeout=15, throttle=None)
+
+    A requests.Session for the GitHub (Enterprise) API, shared by every
+    worker, so that connections (and their TLS handshakes) are kept alive and
+    re-used rather than made anew for each request. At most pool_size
+    connections are kept open (and in use at once), and every request times
+    out after `timeout` seconds unless told otherwise. A path (e.g.,
+    /repos/owner/name) is taken to be relative to base_url.
+
+    Inputs
+    ------
+    uname : str
+        GitHub Enterprise username
+    password : str
+        (e.g., output of load_ghpw)
+    base_url : str
+        (e.g., https://github.ubc.ca/api/v3)
+    gh : Github object or None
+        Used to make PyGithub objects from responses (cf. get_object).
+    pool_size : int
+        (e.g., the number of workers)
+    timeout : float
+    throttle : bool, float, limiter or None
+        Applied before every request (cf. ratelimit.wait), so that callers
+        needn't. If it has an update_from_headers method (e.g.,
+        AdaptiveThrottle), it is also given the headers of every response.
+    """
+
+    def __init__(
+        self,
+        uname,
+        password,
+        base_url,
+        gh=None,
+        pool_size=10,
+        timeout=15,
+        throttle=None,
+    ):
+        super().__init__()
+        self.auth = (uname, password)
+        self.headers["Accept"] = "application/vnd.github.v3+json"
+        self.base_url = base_url.rstrip("/")
+        self.gh = gh
+        self.timeout = timeout
+        self.throttle = throttle
+        adapter = HTTPAdapter(
+            pool_connections=1, pool_maxsize=pool_size, pool_block=True
+        )
+        self.mount("https://", adapter)
+        self.mount("http://", adapter)
+        self.hooks["response"].append(timing.count_request)
+        if hasattr(throttle, "update_from_headers"):
+            self.hooks["response"].append(
+                lambda response, *args, **kwargs: throttle.update_from_headers(
+                    response.headers
+                )
+            )
+
+    def __repr__(self):
+        return f"GitHubSession({self.base_url!r}, timeout={self.timeout})"
+
+    def request(self, method, url, **kwargs):
+        if url.startswith("/"):
+            url = self.base_url + url
+        kwargs.setdefault("timeout", self.timeout)
+        ratelimit.wait(self.throttle)
+        return super().request(method, url, **kwargs)
+
+    def get_object(self, klass, url, etag=None):
+        """
+        get_object(klass, url, etag=None)
+
+        Returns the PyGithub object of class klass (e.g., Repository) at url.
+        If etag is given, the request is conditional: None is returned if the
+        object hasn't changed since (a "304 Not Modified" response, which
+        does not count against the API rate limit).
+        """
+        headers = {} if etag is None else {"If-None-Match": etag}
+        response = self.get(url, headers=headers)
+        if response.status_code == 304:
+            return None
+        response.raise_for_status()
+        return self.gh.create_from_raw_data(
+            klass, response.json(), _lower_keys(response.headers)
+        )
+
+    def get_objects(self, klass, url):
+        """
+        get_objects(klass, url)
+
+        Returns the list of PyGithub objects of class klass (e.g.,
+        ContentFile) at url (e.g., a directory listing).
+        """
+        response = self.get(url)
+        response.raise_for_status()
+        headers = _lower_keys(response.headers)
+        return [
+            self.gh.create_from_raw_data(klass, raw, headers)
+            for raw in response.json()
+        ]
+
+
+def _lower_keys(headers):
+    # PyGithub looks up (e.g.) the ETag as headers["etag"]
+    return {f"{k}".lower(): v for k, v in headers.items()}
+
+
+def graphql_url(base_url):
+    """
+    graphql_url(base_url)
+
+    Returns the GraphQL endpoint of the API whose REST endpoint is base_url
+    (e.g., https://github.ubc.ca/api/v3 -> https://github.ubc.ca/api/graphql).
+    """
+    base_url = base_url.rstrip("/")
+    if base_url.endswith("/api/v3"):
+        return base_url[: -len("v3")] + "graphql"
+    return base_url + "/graphql"
+
+
+def graphql(session, url, query):
+    """
+    graphql(session, url, query)
+
+    Runs a GraphQL query. An HTTP error (e.g., 403 or 502) is raised as a
+    requests.HTTPError, so that it can be retried (cf.
+    ratelimit.call_with_retries).
+
+    Inputs
+    ------
+    session : requests.Session
+        (e.g., a GitHubSession)
+    url : str
+        (e.g., output of graphql_url)
+    query : str
+
+    Returns
+    -------
+    data : dict
+    errors : list
+        GraphQL errors (e.g., one of type NOT_FOUND for each missing repo)
+    """
+    response = session.post(url, json={"query": query})
+    response.raise_for_status()
+    result = response.json()
+    return result.get("data") or {}, result.get("errors") or []
+
+
+def get_raw_blob(session, url):
+    """
+    get_raw_blob(session, url)
+
+    Returns the content of the git blob at url, downloaded as raw bytes
+    (rather than base64-encoded in a JSON object, which is a third larger and
+    takes several copies to decode).
+
+    Inputs
+    ------
+    session : requests.Session
+    url : str
+        (e.g., {repo.url}/git/blobs/{sha})
+    """
+    headers = {"Accept": "application/vnd.github.v3.raw"}
+    response = session.get(url, headers=headers)
+    response.raise_for_status()
+    return response.content
+
+
+_ROOT_TREE_FIELDS = (
+    "nameWithOwner "
+    'object(expression: "HEAD:") { ... on Tree { entries { name type oid } } }'
+)
+
+
+def get_root_trees(
+    session, url, owner, names, batch_size=50, throttle=False, num_tries=5
+):
+    """
+    get_root_trees(session, url, owner, names, batch_size=50, throttle=False,
+                   num_tries=5)
+
+    Returns the entries of the top-level tree of the default branch of each
+    repo owner/name, for name in names. Each GraphQL query looks up
+    batch_size repos at once (as aliased fields), so that the whole cohort
+    takes a few queries instead of two REST calls per student.
+
+    Inputs
+    ------
+    session : requests.Session
+    url : str
+        GraphQL endpoint (cf. graphql_url)
+    owner : str
+        (e.g., 'MDS-2019-20')
+    names : list of str
+        (e.g., ['DSCI_571_lab4_gid1', 'DSCI_571_lab4_gid2'])
+    batch_size : int
+    throttle : bool, float, TokenBucket or AdaptiveThrottle
+        The session's throttle, deferred on a rate-limit error (cf.
+        ratelimit.call_with_retries).
+    num_tries : int
+        Max number of tries per query.
+
+    Returns
+    -------
+    trees : dict
+        keys are names; values are dicts with keys "repo" (owner/name) and
+        "entries" (a list of dicts with keys "name", "type" and "oid"), or
+        None if the repo (or its default branch) doesn't exist.
+    """
+    trees = {}
+    for start in range(0, len(names), batch_size):
+        batch = names[start : start + batch_size]
+        fields = "\n".join(
+            f"r{i}: repository(owner: {json.dumps(owner)}, "
+            f"name: {json.dumps(name)}) {{ {_ROOT_TREE_FIELDS} }}"
+            for i, name in enumerate(batch)
+        )
+        func = partial(graphql, session, url, f"query {{\n{fields}\n}}")
+        data, errors = ratelimit.call_with_retries(
+            func, num_tries, throttle, label=f"GraphQL ({owner})"
+        )
+        for error in errors:
+            if error.get("type") != "NOT_FOUND":
+                print(f"GraphQL: {error.get('message')}")
+        for i, name in enumerate(batch):
+            repo = data.get(f"r{i}")
+            if repo is None or repo.get("object") is None:
+                trees[name] = None
+            else:
+                trees[name] = {
+                    "repo": repo["nameWithOwner"],
+                    "entries": repo["object"]["entries"],
+                }
+    return trees
@@ -0,0 +1,363 @@
+"""
+ratelimit.py
+
+Helpers for pacing requests to the GitHub Enterprise API so that fetching a
+whole cohort's lab files does not get us blocked as a bot.
+"""
+import random
+import threading
+import time
+
+import numpy as np
+
+
+class TokenBucket:
+    """
+    TokenBucket(rate, capacity=1)
+
+    A token-bucket rate limiter that may be shared by several worker threads.
+    Tokens accrue at `rate` per second (up to `capacity`), and each call to
+    `acquire` spends one, blocking until a token is available. Short bursts of
+    up to `capacity` requests go through immediately; over longer periods the
+    combined request rate of all workers stays below `rate`.
+
+    Inputs
+    ------
+    rate : float
+        Sustained number of requests per second (across all workers).
+    capacity : int
+        Max number of requests that may be made back-to-back. Default: 1
+    """
+
+    def __init__(self, rate, capacity=1):
+        if rate <= 0:
+            raise ValueError(f"rate must be positive but got {rate}")
+        if capacity < 1:
+            raise ValueError(f"capacity must be at least 1 but got {capacity}")
+        self.rate = float(rate)
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f"TokenBucket(rate={self.rate}, capacity={self.capacity})"
+
+    def acquire(self, tokens=1):
+        """
+        acquire(tokens=1)
+
+        Blocks until `tokens` tokens are available, then spends them.
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                # self._last is in the future while we are deferred
+                if now >= self._last:
+                    accrued = (now - self._last) * self.rate
+                    self._tokens = min(self.capacity, self._tokens + accrued)
+                    self._last = now
+                    if self._tokens >= tokens:
+                        self._tokens -= tokens
+                        return
+                deficit = (tokens - self._tokens) / self.rate
+                delay = (self._last - now) + deficit
+            time.sleep(delay)
+
+    def defer(self, delay):
+        """
+        defer(delay)
+
+        Blocks every caller of `acquire` for the next `delay` seconds (e.g.,
+        when the server asks us to back off).
+        """
+        with self._lock:
+            self._last = max(self._last, time.monotonic() + delay)
+            self._tokens = 0.0
+        return
+
+
+class AdaptiveThrottle:
+    """
+    AdaptiveThrottle(gh=None, threshold=0.5, reserve=10, base=None)
+
+    A rate limiter driven by the API's own quota (the X-RateLimit-Remaining,
+    X-RateLimit-Limit and X-RateLimit-Reset headers of the last response).
+    While more than `threshold` of the quota is left, requests go out at full
+    speed; below that, requests are spaced out more and more, so that by the
+    time only `reserve` requests are left they are spread evenly until the
+    quota resets. It may be shared by several worker threads.
+
+    Inputs
+    ------
+    gh : Github object or None
+        Its rate_limiting and rate_limiting_resettime (which PyGithub updates
+        from every response) are read before each request. If None, call
+        update or update_from_headers instead.
+    threshold : float
+        Fraction of the quota below which requests are slowed down.
+    reserve : int
+        Number of requests kept back until the quota resets.
+    base : TokenBucket or None
+        An optional fixed cap on the request rate, applied as well.
+    """
+
+    def __init__(self, gh=None, threshold=0.5, reserve=10, base=None):
+        self.gh = gh
+        self.threshold = threshold
+        self.reserve = reserve
+        self.base = base
+        self._quota = None
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return (
+            f"AdaptiveThrottle(threshold={self.threshold}, "
+            f"reserve={self.reserve}, base={self.base})"
+        )
+
+    def update(self, remaining, limit, reset):
+        """
+        update(remaining, limit, reset)
+
+        Records the current quota: remaining requests out of limit, until the
+        Unix time reset.
+        """
+        self._quota = (int(remaining), int(limit), float(reset))
+        return
+
+    def update_from_headers(self, headers):
+        """
+        update_from_headers(headers)
+
+        Records the quota from the X-RateLimit-* headers of a response, if
+        present.
+        """
+        headers = {f"{k}".lower(): v for k, v in headers.items()}
+        try:
+            self.update(
+                headers["x-ratelimit-remaining"],
+                headers["x-ratelimit-limit"],
+                headers["x-ratelimit-reset"],
+            )
+        except (KeyError, ValueError):
+            pass
+        return
+
+    def quota(self):
+        """
+        quota()
+
+        Returns (remaining, limit, reset), or None if the server does not
+        report a rate limit.
+        """
+        if self.gh is not None:
+            try:
+                remaining, limit = self.gh.rate_limiting
+                self.update(remaining, limit, self.gh.rate_limiting_resettime)
+            except Exception:
+                # e.g., rate limiting is not enabled on this server
+                self.gh = None
+        return self._quota
+
+    def interval(self):
+        """
+        interval()
+
+        Returns the number of seconds to leave between requests, given the
+        current quota.
+        """
+        quota = self.quota()
+        if quota is None:
+            return 0.0
+        remaining, limit, reset = quota
+        if limit <= 0:
+            return 0.0
+        time_left = max(reset - time.time(), 0.0)
+        usable = remaining - self.reserve
+        if usable <= 0:
+            return time_left
+        fraction = remaining / limit
+        if fraction >= self.threshold:
+            return 0.0
+        slow_down = 1 - fraction / self.threshold
+        return slow_down * time_left / usable
+
+    def acquire(self, tokens=1):
+        """
+        acquire(tokens=1)
+
+        Blocks until the next request may be made.
+        """
+        if self.base is not None:
+            self.base.acquire(tokens)
+        interval = tokens * self.interval()
+        with self._lock:
+            now = time.monotonic()
+            start = max(self._next, now)
+            self._next = start + interval
+        if start > now:
+            time.sleep(start - now)
+        return
+
+    def defer(self, delay):
+        """
+        defer(delay)
+
+        Blocks every caller of `acquire` for the next `delay` seconds.
+        """
+        with self._lock:
+            self._next = max(self._next, time.monotonic() + delay)
+        if self.base is not None:
+            self.base.defer(delay)
+        return
+
+
+def wait(throttle):
+    """
+    wait(throttle)
+
+    Waits before a request, as prescribed by throttle.
+
+    Inputs
+    ------
+    throttle : bool, float or limiter
+        If True, sleep for one second; if a number, sleep for that many
+        seconds. If an object with an `acquire` method (e.g., a TokenBucket
+        or AdaptiveThrottle), block on `throttle.acquire()` instead.
+    """
+    if hasattr(throttle, "acquire"):
+        throttle.acquire()
+    elif throttle is True:
+        time.sleep(1)
+    elif np.isscalar(throttle):
+        time.sleep(throttle)
+    return
+
+
+def _status_and_headers(exc):
+    # GithubException has .status and .headers; requests' HTTPError has
+    # .response.status_code and .response.headers.
+    status = getattr(exc, "status", None)
+    headers = getattr(exc, "headers", None)
+    response = getattr(exc, "response", None)
+    if status is None and response is not None:
+        status = getattr(response, "status_code", None)
+        headers = getattr(response, "headers", None)
+    headers = {f"{k}".lower(): v for k, v in (headers or {}).items()}
+    return status, headers
+
+
+def classify_error(exc):
+    """
+    classify_error(exc)
+
+    Returns how a failed request should be treated:
+        "rate_limit" : we were throttled (429, or 403 with a rate-limit or
+                       Retry-After header); retry once the server allows it.
+        "transient"  : a server error (5xx) or network failure; retry soon.
+        "permanent"  : anything else (e.g., a 404 for a missing repo); don't
+                       retry.
+
+    Inputs
+    ------
+    exc : Exception
+        (e.g., a GithubException)
+    """
+    status, headers = _status_and_headers(exc)
+    if status is None:
+        return "transient" if isinstance(exc, OSError) else "permanent"
+    if status == 429:
+        return "rate_limit"
+    if status == 403:
+        if "retry-after" in headers:
+            return "rate_limit"
+        if headers.get("x-ratelimit-remaining") == "0":
+            return "rate_limit"
+        message = f"{exc}".lower()
+        if ("rate limit" in message) or ("abuse" in message):
+            return "rate_limit"
+        return "permanent"
+    if status >= 500:
+        return "transient"
+    return "permanent"
+
+
+def retry_delay(exc, attempt, base_delay=1.0, max_delay=60.0):
+    """
+    retry_delay(exc, attempt, base_delay=1.0, max_delay=60.0)
+
+    Returns the number of seconds to wait before retrying a request that
+    failed with exc, or None if it should not be retried (cf.
+    classify_error). If the server says when to retry (Retry-After or
+    X-RateLimit-Reset), that is honoured; otherwise the delay grows
+    exponentially with attempt, with random jitter so that several workers
+    don't retry in lock-step.
+
+    Inputs
+    ------
+    exc : Exception
+    attempt : int
+        Number of attempts that have failed so far (starting from 1).
+    base_delay : float
+    max_delay : float
+        Cap on the exponential backoff (not on server-requested waits).
+    """
+    kind = classify_error(exc)
+    if kind == "permanent":
+        return None
+    if kind == "rate_limit":
+        _, headers = _status_and_headers(exc)
+        try:
+            if "retry-after" in headers:
+                return float(headers["retry-after"])
+            if "x-ratelimit-reset" in headers:
+                reset = float(headers["x-ratelimit-reset"])
+                return max(reset - time.time(), 0.0) + 1.0
+        except ValueError:
+            pass
+    delay = min(max_delay, base_delay * 2 ** (attempt - 1))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def call_with_retries(
+    func, num_tries=5, throttle=None, base_delay=1.0, max_delay=60.0, label=""
+):
+    """
+    call_with_retries(func, num_tries=5, throttle=None, base_delay=1.0,
+                      max_delay=60.0, label="")
+
+    Returns func(), retrying up to num_tries times in all when it raises an
+    error that is worth retrying (cf. classify_error and retry_delay). The
+    last error is raised if every try fails, or if it is permanent.
+
+    Inputs
+    ------
+    func : callable
+        Called with no arguments (e.g., a functools.partial).
+    num_tries : int
+    throttle : bool, float, TokenBucket or AdaptiveThrottle
+        If a limiter, a rate-limit wait is applied to it (with its defer
+        method), pausing every worker that shares it.
+    base_delay : float
+    max_delay : float
+    label : str
+        Printed with each error (e.g., the student's GitHub ID).
+    """
+    for attempt in range(1, num_tries + 1):
+        try:
+            return func()
+        except Exception as exc:
+            delay = retry_delay(exc, attempt, base_delay, max_delay)
+            if (delay is None) or (attempt == num_tries):
+                print(f"{label}: {exc} (giving up after {attempt} tries)")
+                raise
+            print(f"{label}: {exc} (retrying in {delay:.1f}s)")
+            if (classify_error(exc) == "rate_limit") and hasattr(
+                throttle, "defer"
+            ):
+                throttle.defer(delay)
+            else:
+                time.sleep(delay)
+    return
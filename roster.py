@@ -0,0 +1,354 @@
+"""
+roster.py
+
+The class list (classy.csv), indexed by lab section, and the ways of splitting
+it into groups (sections, or each TA's students) and each group into pages.
+"""
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+import util
+
+
+class Roster:
+    """
+    Roster(gids, sections=None, fname=None)
+
+    The students of a course, in the order of the class list, with their lab
+    sections (if known).
+
+    Inputs
+    ------
+    gids : array of str
+        The students' GitHub IDs
+    sections : array of str or None
+        The lab section of each student (e.g., L02)
+    fname : str or None
+        The file the roster was read from (for messages)
+    """
+
+    def __init__(self, gids, sections=None, fname=None):
+        self.gids = np.asarray(gids, dtype=object)
+        self.fname = fname
+        if sections is None:
+            self.sections = None
+            self._by_section = {}
+        else:
+            self.sections = np.asarray(sections, dtype=object)
+            # positions (in roster order) of each section's students
+            self._by_section = (
+                pd.Series(np.arange(self.gids.size))
+                .groupby(self.sections, sort=True)
+                .indices
+            )
+
+    def __repr__(self):
+        return (
+            f"Roster({self.gids.size} students, "
+            f"{len(self._by_section)} sections)"
+        )
+
+    def __len__(self):
+        return self.gids.size
+
+    @classmethod
+    def from_csv(cls, fname, gid_column="id0", section_column=None):
+        """
+        from_csv(fname, gid_column="id0", section_column=None)
+
+        Reads the roster from a class list (e.g., classy.csv).
+
+        Inputs
+        ------
+        fname : str
+        gid_column : str
+            The column with the students' GitHub IDs
+        section_column : str or None
+            The column with their lab sections. Default: the first column
+            whose name contains "section" or "Section", if any.
+        """
+        gid_df = pd.read_csv(fname)
+        if section_column is None:
+            columns = gid_df.filter(regex="[Ss]ection").columns
+            section_column = columns[0] if len(columns) > 0 else None
+        sections = None
+        if section_column is not None:
+            sections = gid_df[section_column].values
+        return cls(gid_df[gid_column].values, sections, fname)
+
+    @property
+    def section_names(self):
+        return list(self._by_section)
+
+    def select(self, sections=None):
+        """
+        select(sections=None)
+
+        Returns the GitHub IDs of the students in sections, in roster order.
+
+        Inputs
+        ------
+        sections : str, list of str or None
+            Default: all students
+        """
+        if sections is None:
+            return self.gids
+        if isinstance(sections, str):
+            sections = [sections]
+        unknown = [x for x in sections if x not in self._by_section]
+        if len(unknown) > 0:
+            raise ValueError(
+                f"Section(s) {unknown} not found in {self.fname}; expected "
+                f"one of {self.section_names}."
+            )
+        positions = np.concatenate([self._by_section[x] for x in sections])
+        return self.gids[np.unique(positions)]
+
+    def assigned(self, assignments):
+        """
+        assigned(assignments)
+
+        Returns the GitHub IDs of the students assigned to each TA (cf.
+        read_assignments), in roster order.
+
+        Inputs
+        ------
+        assignments : dict
+            (output of read_assignments)
+
+        Returns
+        -------
+        groups : dict of arrays
+            GitHub IDs, by TA
+        """
+        groups = {}
+        for ta, assignment in assignments.items():
+            selected = np.isin(self.gids, assignment["gids"])
+            if len(assignment["sections"]) > 0:
+                sections = self.select(assignment["sections"])
+                selected |= np.isin(self.gids, sections)
+            unknown = np.setdiff1d(assignment["gids"], self.gids)
+            if unknown.size > 0:
+                print(f"{ta}: gids {list(unknown)} not in {self.fname}.")
+            groups[ta] = self.gids[selected]
+        return groups
+
+    def groups(
+        self, sections=None, assignments=None, tas=None, label_sections=False
+    ):
+        """
+        groups(sections=None, assignments=None, tas=None,
+               label_sections=False)
+
+        Returns the groups of students to write separate pages for: each TA's
+        students, if assignments are given; otherwise each section, if
+        several are given (or if label_sections); otherwise one group of every
+        student in sections.
+
+        Inputs
+        ------
+        sections : str, list of str or None
+            Default: all sections
+        assignments : dict or None
+            (cf. read_assignments)
+        tas : list of str or None
+            Only these TAs' groups. Default: every TA in assignments.
+        label_sections : bool
+            If True, a single section given in sections is also its own group,
+            labelled with its name (e.g., so that its pages don't have the same
+            names as another section's in a batch).
+
+        Returns
+        -------
+        groups : dict of arrays
+            GitHub IDs, by the label of their pages (None for a single group,
+            whose pages are named as they would be without groups).
+        """
+        if assignments is not None:
+            groups = self.assigned(assignments)
+            if tas is not None:
+                unknown = [x for x in tas if x not in groups]
+                if len(unknown) > 0:
+                    raise ValueError(
+                        f"TA(s) {unknown} not found; expected one of "
+                        f"{list(groups)}."
+                    )
+                groups = {ta: groups[ta] for ta in tas}
+            return groups
+        if isinstance(sections, str):
+            sections = [sections]
+        if sections is not None and (len(sections) > 1 or label_sections):
+            return {x: self.select([x]) for x in sections}
+        return {None: self.select(sections)}
+
+    def union(self, groups):
+        """
+        union(groups)
+
+        Returns the GitHub IDs of the students in any of groups (a dict of
+        arrays, cf. groups), in roster order, so that they can be fetched
+        once.
+        """
+        gid_arrays = list(groups.values())
+        if len(gid_arrays) == 1:
+            return gid_arrays[0]
+        return self.gids[np.isin(self.gids, np.concatenate(gid_arrays))]
+
+
+def read_assignments(fname):
+    """
+    read_assignments(fname)
+
+    Reads the assignments of students to TAs from a CSV file with a "ta"
+    column, and a "section" column (to assign all students of a section)
+    and/or an "id0" (or "gid") column (to assign single students). Each row
+    assigns one section or student.
+
+    Returns
+    -------
+    assignments : dict
+        {ta: {"sections": [...], "gids": [...]}}, in order of first
+        appearance
+    """
+    df = pd.read_csv(fname)
+    if "ta" not in df.columns:
+        raise ValueError(f"Expected a 'ta' column in {fname}.")
+    section_column = next(
+        (x for x in df.columns if x.lower() == "section"), None
+    )
+    gid_column = next((x for x in ("id0", "gid") if x in df.columns), None)
+    if section_column is None and gid_column is None:
+        raise ValueError(
+            f"Expected a 'section' and/or 'id0' (or 'gid') column in {fname}."
+        )
+    assignments = {}
+    for ta, ta_df in df.groupby("ta", sort=False):
+        sections = []
+        gids = []
+        if section_column is not None:
+            sections = list(ta_df[section_column].dropna().unique())
+        if gid_column is not None:
+            gids = list(ta_df[gid_column].dropna().unique())
+        assignments[ta] = {"sections": sections, "gids": gids}
+    return assignments
+
+
+def paginate(gid_list, spp):
+    """
+    paginate(gid_list, spp)
+
+    Returns gid_list split into pages of spp students (the last page may
+    have fewer, but none is empty).
+
+    Returns
+    -------
+    gid_pages : dict of lists
+        Students by page number
+    """
+    return {
+        page: list(gid_list[start : start + spp])
+        for page, start in enumerate(range(0, len(gid_list), spp))
+    }
+
+
+def balance_pages(gid_list, sizes, max_size):
+    """
+    balance_pages(gid_list, sizes, max_size)
+
+    Returns gid_list split into as few pages as there must be for each to hold
+    about max_size bytes, with about the same size on each page (rather than
+    the same number of students). Students keep their order.
+
+    Inputs
+    ------
+    gid_list : array of str
+    sizes : array of ints
+        The (rendered) size of each student's answer, in bytes
+    max_size : float
+        In bytes
+
+    Returns
+    -------
+    gid_pages : dict of lists
+        Students by page number
+    """
+    sizes = np.asarray(sizes, dtype=float)
+    if sizes.size == 0:
+        return {}
+    total = sizes.sum()
+    num_pages = max(int(np.ceil(total / max_size)), 1)
+    # each student goes on the page its midpoint falls on
+    midpoints = np.cumsum(sizes) - sizes / 2
+    page_of = np.minimum(
+        (midpoints * num_pages / total).astype(int), num_pages - 1
+    )
+    gid_list = np.asarray(gid_list, dtype=object)
+    boundaries = np.flatnonzero(np.diff(page_of)) + 1
+    return {
+        page: list(gid_page)
+        for page, gid_page in enumerate(np.split(gid_list, boundaries))
+    }
+
+
+def estimate_sizes(gid_list, known_sizes):
+    """
+    estimate_sizes(gid_list, known_sizes)
+
+    Returns the size of each student's answer, as recorded in known_sizes
+    (cf. load_sizes), with the median size for those not recorded, or None
+    if no size is recorded.
+    """
+    sizes = np.array([known_sizes.get(gid, np.nan) for gid in gid_list])
+    if sizes.size == 0 or np.all(np.isnan(sizes)):
+        return None
+    sizes[np.isnan(sizes)] = np.nanmedian(sizes)
+    return sizes
+
+
+def make_pages(gid_list, spp, known_sizes=None, max_size=None):
+    """
+    make_pages(gid_list, spp, known_sizes=None, max_size=None)
+
+    Returns gid_list split into pages: balanced by size (cf. balance_pages)
+    if max_size is given and the sizes of the students' answers are known
+    (cf. estimate_sizes), otherwise spp students per page (cf. paginate).
+    """
+    if max_size is not None and known_sizes is not None:
+        sizes = estimate_sizes(gid_list, known_sizes)
+        if sizes is not None:
+            return balance_pages(gid_list, sizes, max_size)
+        print("No sizes recorded for this exercise yet; paginating by count.")
+    return paginate(gid_list, spp)
+
+
+def exercise_key(exercise_num):
+    """
+    exercise_key(exercise_num)
+
+    Returns the key of exercise_num (an int, or a list of ints written to the
+    same pages) in the recorded sizes, e.g., "3" or "345" (as in the names
+    of the pages).
+    """
+    return "".join(f"{x}" for x in np.atleast_1d(exercise_num))
+
+
+def load_sizes(fname):
+    """
+    load_sizes(fname)
+
+    Loads the rendered sizes saved by save_sizes: a dict, by exercise (e.g.,
+    "3" or "345"), of the size in bytes of each student's answer. Returns
+    an empty dict if there are none yet.
+    """
+    if not os.path.exists(fname):
+        return {}
+    with open(fname, "r") as fp:
+        return json.load(fp)
+
+
+def save_sizes(fname, sizes):
+    util.atomic_write(fname, json.dumps(sizes, indent=1, sort_keys=True))
+    return
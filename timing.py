@@ -0,0 +1,283 @@
+"""
+timing.py
+
+Records where a run spends its time: the wall time (and bytes) of each stage
+for each student, and the API calls made, for a report at the end of the run
+(cf. --report).
+
+The functions here record to the report passed to start(); until then (or
+after stop()), they do nothing, so the rest of the code can call them
+unconditionally. They may be called from several threads at once.
+"""
+import csv
+import json
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+import numpy as np
+
+
+class RunReport:
+    """
+    RunReport()
+
+    The timings and API calls of one run.
+
+    Attributes
+    ----------
+    records : list of dicts
+        One per stage per student, with keys "stage", "gid", "seconds" and
+        "bytes" (None if not applicable).
+    api_calls : Counter
+        Number of API requests, keyed by (kind, status), e.g.,
+        ("blob", 200) or ("repo", 304).
+    quota : list
+        The rate-limit quota remaining, as (first, last) seen.
+    """
+
+    def __init__(self):
+        self.records = []
+        self.api_calls = Counter()
+        self.quota = [None, None]
+        self.started = time.time()
+        self.finished = None
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return (
+            f"RunReport({len(self.records)} records, "
+            f"{sum(self.api_calls.values())} API calls)"
+        )
+
+    def add(self, stage, seconds, gid=None, nbytes=None):
+        record = {
+            "stage": stage,
+            "gid": gid,
+            "seconds": seconds,
+            "bytes": nbytes,
+        }
+        with self._lock:
+            self.records.append(record)
+        return
+
+    def add_request(self, kind, status, remaining=None):
+        with self._lock:
+            self.api_calls[(kind, status)] += 1
+            if remaining is not None:
+                if self.quota[0] is None:
+                    self.quota[0] = remaining
+                self.quota[1] = remaining
+        return
+
+    def summary(self):
+        """
+        summary()
+
+        Returns one row per stage (in order of first appearance), with the
+        number of times it was timed, its total, median (p50), 95th
+        percentile (p95) and max time in seconds, and its total bytes.
+        """
+        stages = {}
+        for record in self.records:
+            stages.setdefault(record["stage"], []).append(record)
+        rows = []
+        for stage, records in stages.items():
+            seconds = np.array([x["seconds"] for x in records])
+            nbytes = [x["bytes"] for x in records if x["bytes"] is not None]
+            rows.append(
+                {
+                    "stage": stage,
+                    "count": len(records),
+                    "total": float(seconds.sum()),
+                    "p50": float(np.percentile(seconds, 50)),
+                    "p95": float(np.percentile(seconds, 95)),
+                    "max": float(seconds.max()),
+                    "bytes": int(sum(nbytes)) if nbytes else None,
+                }
+            )
+        return rows
+
+    def print_summary(self):
+        """
+        print_summary()
+
+        Prints the summary of each stage, the API calls and the quota used.
+        """
+        finished = self.finished or time.time()
+        print("-" * 50)
+        print(f"Run time: {finished - self.started:.1f}s")
+        print(
+            f"{'stage':<12}{'count':>7}{'total':>10}{'p50':>10}{'p95':>10}"
+            f"{'MB':>9}"
+        )
+        for row in self.summary():
+            mb = "" if row["bytes"] is None else f"{row['bytes'] / 1e6:.1f}"
+            print(
+                f"{row['stage']:<12}{row['count']:>7}{row['total']:>9.2f}s"
+                f"{row['p50']:>9.3f}s{row['p95']:>9.3f}s{mb:>9}"
+            )
+        calls = ", ".join(
+            f"{kind} {status}: {n}"
+            for (kind, status), n in sorted(self.api_calls.items())
+        )
+        print(f"API calls: {sum(self.api_calls.values())} ({calls})")
+        if self.quota[0] is not None:
+            print(
+                f"Rate-limit quota: {self.quota[0]} -> {self.quota[1]} "
+                "requests remaining"
+            )
+        print("-" * 50)
+        return
+
+    def write(self, fname):
+        """
+        write(fname)
+
+        Writes the report to fname: every record as CSV if fname ends in
+        .csv, otherwise the records, summary and API calls as JSON.
+        """
+        if fname.endswith(".csv"):
+            with open(fname, "w", newline="") as fp:
+                writer = csv.DictWriter(
+                    fp, fieldnames=["stage", "gid", "seconds", "bytes"]
+                )
+                writer.writeheader()
+                writer.writerows(self.records)
+            return
+        report = {
+            "started": self.started,
+            "finished": self.finished,
+            "summary": self.summary(),
+            "api_calls": [
+                {"kind": kind, "status": status, "count": n}
+                for (kind, status), n in sorted(self.api_calls.items())
+            ],
+            "quota": {"first": self.quota[0], "last": self.quota[1]},
+            "records": self.records,
+        }
+        with open(fname, "w") as fp:
+            json.dump(report, fp, indent=1)
+        return
+
+
+# The report being recorded to (cf. start), and the student each thread is
+# working on (cf. student)
+_report = None
+_local = threading.local()
+
+
+def start(report=None):
+    """
+    start(report=None)
+
+    Starts recording to report (default: a new RunReport), and returns it.
+    """
+    global _report
+    _report = RunReport() if report is None else report
+    return _report
+
+
+def stop():
+    """
+    stop()
+
+    Stops recording, and returns the report that was being recorded to.
+    """
+    global _report
+    report = _report
+    _report = None
+    if report is not None:
+        report.finished = time.time()
+    return report
+
+
+@contextmanager
+def student(gid):
+    """
+    student(gid)
+
+    Within this context, stages timed by this thread are recorded for the
+    student gid (unless given another gid).
+    """
+    previous = getattr(_local, "gid", None)
+    _local.gid = gid
+    try:
+        yield
+    finally:
+        _local.gid = previous
+
+
+@contextmanager
+def stage(name, gid=None, nbytes=None):
+    """
+    stage(name, gid=None, nbytes=None)
+
+    Times the code within this context as the stage `name` (e.g.,
+    "download") for the student gid (default: cf. student). Yields a dict
+    whose "bytes" may be set within the context, if nbytes isn't known yet.
+    """
+    info = {"bytes": nbytes}
+    if _report is None:
+        yield info
+        return
+    if gid is None:
+        gid = getattr(_local, "gid", None)
+    start_time = time.perf_counter()
+    try:
+        yield info
+    finally:
+        seconds = time.perf_counter() - start_time
+        _report.add(name, seconds, gid, info["bytes"])
+
+
+def add(name, seconds, gid=None, nbytes=None):
+    """
+    add(name, seconds, gid=None, nbytes=None)
+
+    Records that the stage `name` took `seconds` (e.g., as timed in another
+    process).
+    """
+    if _report is not None:
+        if gid is None:
+            gid = getattr(_local, "gid", None)
+        _report.add(name, seconds, gid, nbytes)
+    return
+
+
+def request_kind(url):
+    """
+    request_kind(url)
+
+    Returns the kind of API request made to url: "graphql", "blob",
+    "contents", "repo" or "other".
+    """
+    path = urlparse(url).path
+    if path.endswith("/graphql"):
+        return "graphql"
+    if "/git/blobs/" in path:
+        return "blob"
+    if "/contents" in path:
+        return "contents"
+    if "/repos/" in path:
+        return "repo"
+    return "other"
+
+
+def count_request(response, *args, **kwargs):
+    """
+    count_request(response, *args, **kwargs)
+
+    Records an API request (a requests response hook, cf.
+    ghapi.GitHubSession).
+    """
+    if _report is not None:
+        remaining = response.headers.get("X-RateLimit-Remaining")
+        _report.add_request(
+            request_kind(response.url),
+            response.status_code,
+            None if remaining is None else int(remaining),
+        )
+    return
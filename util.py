@@ -2,7 +2,7 @@ from argparse import ArgumentParser
 import os
 import pickle
 import bz2
-import numpy as np
+import tempfile
 
 
 def to_pklbz2(fname, obj):
@@ -46,6 +46,39 @@ def load_pklbz2(fname):
         return pickle.load(fp)
 
 
+# The process umask, to give files written by atomic_write the usual mode
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+def atomic_write(fname, data):
+    """
+    atomic_write(fname, data)
+
+    Writes data to fname by way of a temporary file in the same directory, so
+    that fname never holds a partially written file (e.g., if the run is
+    interrupted).
+
+    Inputs
+    ------
+    fname : str
+    data : bytes or str
+    """
+    dirname = os.path.dirname(fname) or "."
+    mode = "w" if isinstance(data, str) else "wb"
+    fd, tmp_fname = tempfile.mkstemp(dir=dirname, suffix=".tmp")
+    try:
+        with os.fdopen(fd, mode) as fp:
+            fp.write(data)
+        # mkstemp creates the file as owner-only; use the usual permissions
+        os.chmod(tmp_fname, 0o666 & ~_UMASK)
+        os.replace(tmp_fname, fname)
+    except BaseException:
+        os.remove(tmp_fname)
+        raise
+    return
+
+
 def save_files(save_dir, obj_dict):
     raw_dir = save_dir + "raw/"
     if not os.path.exists(raw_dir):
@@ -83,9 +116,28 @@ parser.add_argument(
         " pass 3 4 5 for Exercises 3--5)"
     ),
 )
+parser.add_argument(
+    "--batch",
+    default=None,
+    help=(
+        "A job spec (JSON, or YAML if PyYAML is installed) listing several "
+        "outputs (course, lab, exercises and sections) to write in one run, "
+        "fetching and parsing each lab's notebooks once (cf. batch.py). "
+        "Replaces --course, --lab, --exercise and --section."
+    ),
+)
 parser.add_argument(
     "--fname", default=None, help="A regex used to search for a file pattern.",
 )
+parser.add_argument(
+    "--pattern",
+    default=None,
+    help=(
+        "A regex matching the markdown headings that start each exercise; "
+        "its first group must capture the exercise number. "
+        r"Default: '\#+.*?Exercise (\d+)'"
+    ),
+)
 parser.add_argument(
     "--gidpath",
     default="classy.csv",
@@ -100,10 +152,29 @@ parser.add_argument(
     "--section",
     default=None,
     type=str,
+    nargs="+",
     help=(
-        "Allows filtering by Lab Section (e.g., section L02). Default: all sections."
+        "Allows filtering by Lab Section (e.g., section L02). Default: all "
+        "sections. If several are given (e.g., L01 L02), separate pages are "
+        "written for each, from one fetch."
     ),
 )
+parser.add_argument(
+    "--assignments",
+    default=None,
+    help=(
+        "A CSV file assigning sections (a 'section' column) and/or students "
+        "(an 'id0' column) to TAs (a 'ta' column). Separate pages are "
+        "written for each TA's students, from one fetch."
+    ),
+)
+parser.add_argument(
+    "--ta",
+    default=None,
+    type=str,
+    nargs="+",
+    help="Only write the pages of these TAs (cf. --assignments).",
+)
 parser.add_argument(
     "--studentsperpage",
     default=15,
@@ -113,38 +184,171 @@ parser.add_argument(
         "studentsperpage many answers. This is done to manage filesize."
     ),
 )
+parser.add_argument(
+    "--pagesize",
+    default=None,
+    type=float,
+    help=(
+        "Balance the pages by size, to about this many MB each, rather than "
+        "by --studentsperpage. Uses the size of each student's answer in an "
+        "earlier run of the same exercise (the first run uses "
+        "--studentsperpage)."
+    ),
+)
 parser.add_argument(
     "--throttle",
     default=0.25,
     type=float,
     help="Min duration to wait (in seconds) between pulling lab files.",
 )
+parser.add_argument(
+    "--workers",
+    default=1,
+    type=int,
+    help="Number of students' lab files to fetch concurrently.",
+)
+parser.add_argument(
+    "--rate",
+    default=None,
+    type=float,
+    help=(
+        "Max requests per second to the GitHub API, shared by all workers. "
+        "If set, this replaces the fixed --throttle sleep."
+    ),
+)
+parser.add_argument(
+    "--burst",
+    default=1,
+    type=int,
+    help="Max number of requests that may be made back-to-back under --rate.",
+)
+parser.add_argument(
+    "--adaptive",
+    action="store_true",
+    help=(
+        "Pace requests by the remaining GitHub API quota: full speed while "
+        "plenty is left, slowing down as it runs out. Replaces the fixed "
+        "--throttle sleep (and is combined with --rate, if given)."
+    ),
+)
+parser.add_argument(
+    "--discover",
+    action="store_true",
+    help=(
+        "Look up every student's repo and lab file at once, with a few "
+        "batched GraphQL queries, instead of two API calls per student."
+    ),
+)
+parser.add_argument(
+    "--poolsize",
+    default=None,
+    type=int,
+    help=(
+        "Max number of connections to the GitHub API kept open (and re-used) "
+        "at once. Default: the number of workers."
+    ),
+)
+parser.add_argument(
+    "--timeout",
+    default=15,
+    type=float,
+    help="Seconds to wait for a response from the GitHub API before retrying.",
+)
+parser.add_argument(
+    "--jobs",
+    default=1,
+    type=int,
+    help="Number of processes used to render the students' answers to HTML.",
+)
+parser.add_argument(
+    "--force",
+    action="store_true",
+    help="Rewrite every HTML page, even those whose inputs haven't changed.",
+)
+parser.add_argument(
+    "--assets",
+    action="store_true",
+    help=(
+        "Save output images to DSCI{course}/Lab{lab}/assets/ (once per "
+        "distinct image) and link to them, rather than embedding them in "
+        "every page."
+    ),
+)
+parser.add_argument(
+    "--fragments",
+    action="store_true",
+    help=(
+        "Write each student's answer to its own file, and one index page "
+        "for the whole cohort that loads them as they are scrolled to "
+        "(instead of --studentsperpage pages)."
+    ),
+)
+parser.add_argument(
+    "--nocache",
+    action="store_true",
+    help=(
+        "Don't use the local cache of downloaded notebooks "
+        "(DSCI{course}/Lab{lab}/blobs/)."
+    ),
+)
+parser.add_argument(
+    "--rendercache",
+    default=200,
+    type=float,
+    help=(
+        "Max size (in MB) of the cache of rendered answers "
+        "(DSCI{course}/Lab{lab}/renders/), from which an answer that was "
+        "rendered before is re-used; the least recently used are removed "
+        "beyond that. 0 to not use it."
+    ),
+)
+parser.add_argument(
+    "--fast",
+    action="store_true",
+    help=(
+        "Render markdown, code and text/image outputs without nbconvert "
+        "(much faster, with the same markup); cells with other outputs "
+        "(e.g., widgets or JavaScript) are still rendered by nbconvert."
+    ),
+)
+parser.add_argument(
+    "--offline",
+    action="store_true",
+    help=(
+        "Don't connect to GitHub; re-render from the lab files saved by a "
+        "previous run (see --doSave)."
+    ),
+)
+parser.add_argument(
+    "--report",
+    default=None,
+    help=(
+        "Time each stage of the run (and count the API calls made), print a "
+        "summary at the end and save the details to this file (.csv or "
+        ".json)."
+    ),
+)
 parser.add_argument(
     "--doSave",
     default=True,
     type=bool,
-    help="Whether to save intermediate lab files as .pkl.bz2 objects.",
-)
-
-
-def format_exercise_num(exercise_num):
-    # Parse exercise_num correctly
-    if isinstance(exercise_num, (list, tuple)):
-        if len(exercise_num) == 0:
-            raise ValueError("exercise_num is mandatory")
-        elif len(exercise_num) == 1:
-            exercise_num = exercise_num[0]
-            assert isinstance(exercise_num, np.int), (
-                f"Expected integer or list of integers for "
-                f"exercise_num but got {exercise_num}."
-            )
-        else:
-            pass
-    else:
-        assert isinstance(
-            exercise_num, np.int
-        ), f"expected int or list of ints for exercise_num but got {exercise_num}"
-    return exercise_num
+    help="Whether to save intermediate lab files (cf. --archive).",
+)
+parser.add_argument(
+    "--archive",
+    default="pack",
+    choices=["pack", "gz", "zst", "lz4", "pklbz2"],
+    help=(
+        "Format of the saved lab files: a single pack file with an index, or "
+        "one gzip/zstd/lz4/pickled bz2 file per student."
+    ),
+)
+parser.add_argument(
+    "--level",
+    default=None,
+    type=int,
+    help="Compression level for --archive gz, zst or lz4.",
+)
 
 
 def print_info(
@@ -157,9 +361,12 @@ def print_info(
     section,
     throttle,
     spp,
+    num_workers=1,
 ):
     if section is None:
         section_str = "in all sections"
+    elif isinstance(section, (list, tuple)):
+        section_str = f"in {', '.join(f'{x}' for x in section)}"
     else:
         section_str = f"in section {section}"
 
@@ -167,4 +374,5 @@ def print_info(
     print(f"Looking for GIDs {section_str} matching those in {gid_filepath}.")
     print(f"Searching for exercise {exercise_num} in files matching {fname}.")
     print(f"throttle: {throttle}, students per output page: {spp}")
+    print(f"workers: {num_workers}")
     return
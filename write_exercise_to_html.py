@@ -9,11 +9,11 @@ Important notes:
 * This code pulls all cells from (inclusive):
       Exercise {exercise_num}
   to (exclusive):
-      Exercise {exercise_num + 1}.
-  Those start/end cells must match the regex
-      "\#+.*Exercise " + f"{exercise_number}"
+      the next exercise with a larger number (typically {exercise_num + 1}).
+  Those start/end cells are markdown cells matching the regex
+      "\#+.*?Exercise (\d+)"
   Necessarily, if the pattern used in the assignments changes, then this
-  code must be updated to match (cf. `pattern` in `get_cell_loc`).
+  regex must be updated to match (pass --pattern, or cf. `EXERCISE_PATTERN`).
 
 
 Example usage:
@@ -21,14 +21,36 @@ Example usage:
 > python3 write_exercise_to_html.py --uname=aberk --course=572 --lab=1
                                     --exercise 3 4 --section=L02 --throttle=.75
 
+To mark another exercise of a lab that was already fetched, without
+connecting to GitHub:
+> python3 write_exercise_to_html.py --course=572 --lab=1 --exercise 5
+                                    --section=L02 --offline
+
+To fetch several students at once while capping the overall request rate:
+> python3 write_exercise_to_html.py --uname=aberk --course=572 --lab=1
+                                    --exercise 3 --workers=8 --rate=4
+
 
 usage: write_exercise_to_html.py [-h] [--uname UNAME] [--course COURSE]
                                  [--lab LAB]
                                  [--exercise [EXERCISE [EXERCISE ...]]]
-                                 [--fname FNAME] [--gidpath GIDPATH]
-                                 [--section SECTION]
+                                 [--batch BATCH] [--fname FNAME]
+                                 [--pattern PATTERN] [--gidpath GIDPATH]
+                                 [--section SECTION [SECTION ...]]
+                                 [--assignments ASSIGNMENTS]
+                                 [--ta TA [TA ...]]
                                  [--studentsperpage STUDENTSPERPAGE]
-                                 [--throttle THROTTLE] [--doSave DOSAVE]
+                                 [--pagesize PAGESIZE] [--throttle THROTTLE]
+                                 [--workers WORKERS] [--rate RATE]
+                                 [--burst BURST] [--adaptive] [--discover]
+                                 [--poolsize POOLSIZE] [--timeout TIMEOUT]
+                                 [--jobs JOBS] [--force] [--assets]
+                                 [--fragments] [--nocache]
+                                 [--rendercache RENDERCACHE] [--fast]
+                                 [--offline] [--report REPORT]
+                                 [--doSave DOSAVE]
+                                 [--archive {pack,gz,zst,lz4,pklbz2}]
+                                 [--level LEVEL]
 
 Slice exercises from student lab files for easier marking.
 
@@ -41,41 +63,143 @@ optional arguments:
   --exercise [EXERCISE [EXERCISE ...]]
                         The exercise number (e.g., pass 3 for Exercise 3; pass
                         3 4 5 for Exercises 3--5)
+  --batch BATCH         A job spec (JSON, or YAML if PyYAML is installed)
+                        listing several outputs (course, lab, exercises and
+                        sections) to write in one run, fetching and parsing
+                        each lab's notebooks once (cf. batch.py). Replaces
+                        --course, --lab, --exercise and --section.
   --fname FNAME         A regex used to search for a file pattern.
+  --pattern PATTERN     A regex matching the markdown headings that start each
+                        exercise; its first group must capture the exercise
+                        number. Default: '\#+.*?Exercise (\d+)'
   --gidpath GIDPATH     The list of the students GitHub IDs to use. Note: a
                         list with non-matching entries may cause the script to
                         break or hang.
-  --section SECTION     Allows filtering by Lab Section (e.g., section L02).
-                        Default: all sections.
+  --section SECTION [SECTION ...]
+                        Allows filtering by Lab Section (e.g., section L02).
+                        Default: all sections. If several are given (e.g., L01
+                        L02), separate pages are written for each, from one
+                        fetch.
+  --assignments ASSIGNMENTS
+                        A CSV file assigning sections (a 'section' column)
+                        and/or students (an 'id0' column) to TAs (a 'ta'
+                        column). Separate pages are written for each TA's
+                        students, from one fetch.
+  --ta TA [TA ...]      Only write the pages of these TAs (cf. --assignments).
   --studentsperpage STUDENTSPERPAGE
                         Each HTML page that's generated will contain
                         studentsperpage many answers. This is done to manage
                         filesize.
+  --pagesize PAGESIZE   Balance the pages by size, to about this many MB each,
+                        rather than by --studentsperpage. Uses the size of
+                        each student's answer in an earlier run of the same
+                        exercise (the first run uses --studentsperpage).
   --throttle THROTTLE   Min duration to wait (in seconds) between pulling lab
                         files.
-  --doSave DOSAVE       Whether to save intermediate lab files as .pkl.bz2
-                        objects.
+  --workers WORKERS     Number of students' lab files to fetch concurrently.
+  --rate RATE           Max requests per second to the GitHub API, shared by
+                        all workers. If set, this replaces the fixed
+                        --throttle sleep.
+  --burst BURST         Max number of requests that may be made back-to-back
+                        under --rate.
+  --adaptive            Pace requests by the remaining GitHub API quota: full
+                        speed while plenty is left, slowing down as it runs
+                        out. Replaces the fixed --throttle sleep (and is
+                        combined with --rate, if given).
+  --discover            Look up every student's repo and lab file at once,
+                        with a few batched GraphQL queries, instead of two API
+                        calls per student.
+  --poolsize POOLSIZE   Max number of connections to the GitHub API kept open
+                        (and re-used) at once. Default: the number of workers.
+  --timeout TIMEOUT     Seconds to wait for a response from the GitHub API
+                        before retrying.
+  --jobs JOBS           Number of processes used to render the students'
+                        answers to HTML.
+  --force               Rewrite every HTML page, even those whose inputs
+                        haven't changed.
+  --assets              Save output images to DSCI{course}/Lab{lab}/assets/
+                        (once per distinct image) and link to them, rather
+                        than embedding them in every page.
+  --fragments           Write each student's answer to its own file, and one
+                        index page for the whole cohort that loads them as
+                        they are scrolled to (instead of --studentsperpage
+                        pages).
+  --nocache             Don't use the local cache of downloaded notebooks
+                        (DSCI{course}/Lab{lab}/blobs/).
+  --rendercache RENDERCACHE
+                        Max size (in MB) of the cache of rendered answers
+                        (DSCI{course}/Lab{lab}/renders/), from which an answer
+                        that was rendered before is re-used; the least
+                        recently used are removed beyond that. 0 to not use
+                        it.
+  --fast                Render markdown, code and text/image outputs without
+                        nbconvert (much faster, with the same markup); cells
+                        with other outputs (e.g., widgets or JavaScript) are
+                        still rendered by nbconvert.
+  --offline             Don't connect to GitHub; re-render from the lab files
+                        saved by a previous run (see --doSave).
+  --report REPORT       Time each stage of the run (and count the API calls
+                        made), print a summary at the end and save the details
+                        to this file (.csv or .json).
+  --doSave DOSAVE       Whether to save intermediate lab files (cf.
+                        --archive).
+  --archive {pack,gz,zst,lz4,pklbz2}
+                        Format of the saved lab files: a single pack file with
+                        an index, or one gzip/zstd/lz4/pickled bz2 file per
+                        student.
+  --level LEVEL         Compression level for --archive gz, zst or lz4.
 
 Copyright Aaron Berk 2019
 Modify and distribute as you please.
 """
 import numpy as np
-import pandas as pd
-from github import Github, GithubException
+from github import Github
+from github.ContentFile import ContentFile
+from github.Repository import Repository
 import os
 import base64
+import copy
+import hashlib
+import html
+import json
 import re
 import time
+from collections import deque
+from functools import lru_cache, partial
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from IPython.display import display, HTML
 import nbformat
+import nbconvert
 from nbconvert import HTMLExporter
-
+from traitlets.config import Config
+
+import archive
+import batch
+import cache
+import fastrender
+import ghapi
+import ratelimit
+import roster
+import timing
 import util
 
 
-def get_repo(gh, gid, lab_num, course_num="571", year_tag=None, throttle=False):
+# Markdown heading that starts an exercise; the group is the exercise number.
+EXERCISE_PATTERN = r"\#+.*?Exercise (\d+)"
+
+
+def get_repo(
+    gh,
+    gid,
+    lab_num,
+    course_num="571",
+    year_tag=None,
+    throttle=False,
+    session=None,
+):
     """
-    get_repo(gh, gid, lab_num, course_num='571', year_tag=None, throttle=False)
+    get_repo(gh, gid, lab_num, course_num='571', year_tag=None, throttle=False,
+             session=None)
 
     Returns a repo object from the GitHub API
 
@@ -90,9 +214,15 @@ def get_repo(gh, gid, lab_num, course_num="571", year_tag=None, throttle=False):
         The course number (e.g., DSCI '571')
     year_tag : str
         e.g., 'MDS-2019-20'
-    throttle : bool or float
+    throttle : bool, float, TokenBucket or AdaptiveThrottle
         Whether to slow down this function so that we're not blocked as a bot.
+        A TokenBucket or AdaptiveThrottle (see ratelimit.py) may be shared
+        between workers.
         Default: False
+    session : GitHubSession or None
+        If given, the request is made with this (shared, pooled) session
+        instead of gh's own connection (and throttled by the session).
+        Default: None
 
     Returns
     -------
@@ -100,18 +230,23 @@ def get_repo(gh, gid, lab_num, course_num="571", year_tag=None, throttle=False):
     """
     if year_tag is None:
         year_tag = "MDS-2019-20"
-    if throttle is True:
-        time.sleep(1)
-    elif np.isscalar(throttle):
-        time.sleep(throttle)
-    repo = gh.get_repo(f"{year_tag}/DSCI_{course_num}_lab{lab_num}_{gid}")
+    full_name = f"{year_tag}/DSCI_{course_num}_lab{lab_num}_{gid}"
+    with timing.stage("repo"):
+        if session is not None:
+            repo = session.get_object(Repository, f"/repos/{full_name}")
+        else:
+            ratelimit.wait(throttle)
+            repo = gh.get_repo(full_name)
     print(f"Fetched: {repo.name}")
     return repo
 
 
-def get_file_from_repo(fname, repo, throttle=False, use_fuzzy=True):
+def get_file_from_repo(
+    fname, repo, throttle=False, use_fuzzy=True, blob_cache=None, session=None
+):
     """
-    get_file_from_repo(fname, repo, throttle=False)
+    get_file_from_repo(fname, repo, throttle=False, use_fuzzy=True,
+                       blob_cache=None, session=None)
 
     Returns file with name fname from the repo `repo`.
 
@@ -121,51 +256,443 @@ def get_file_from_repo(fname, repo, throttle=False, use_fuzzy=True):
         (e.g., lab2.ipynb)
     repo : Github repo object
         (e.g., see get_repo function)
-    throttle : bool or float
+    throttle : bool, float or TokenBucket
         Whether to slow down this function so that we're not blocked as a bot.
         Default: False
     use_fuzzy : bool
         If True, fname can be a regex; otherwise we look for exact match.
+    blob_cache : BlobCache or None
+        If given, the file is read from (or saved to) this cache, keyed by
+        its git blob SHA, instead of always being downloaded.
+    session : GitHubSession or None
+        If given, the repo is listed, and the file downloaded as raw bytes,
+        with this session (cf. find_file_in_repo and get_blob).
     """
-    if throttle is True:
-        time.sleep(1)
-    elif np.isscalar(throttle):
-        time.sleep(throttle)
+    if session is None:
+        ratelimit.wait(throttle)
+    contents = find_file_in_repo(fname, repo, use_fuzzy, session)
+    return get_blob(repo, contents, blob_cache, session, throttle)
+
+
+def find_file_in_repo(fname, repo, use_fuzzy=True, session=None):
+    """
+    find_file_in_repo(fname, repo, use_fuzzy=True, session=None)
+
+    Returns the contents object (path, name, sha, ...) of the file matching
+    fname in the top level of the repo `repo`, without downloading the file.
 
+    Inputs
+    ------
+    fname : str
+    repo : Github repo object
+    use_fuzzy : bool
+        If True, fname can be a regex; otherwise we look for exact match.
+    session : GitHubSession or None
+        If given, the repo is listed with this session.
+    """
     if use_fuzzy:
-        dir_contents = repo.get_dir_contents("./")
-        try:
-            contents = next(x for x in dir_contents if re.search(fname, x.path))
-        except StopIteration:
-            print(
-                f"No matches found using {fname}.\n"
-                "Weakening to look for any ipynb file."
-            )
-            contents = next(
-                x for x in dir_contents if re.search(".*ipynb", x.path)
-            )
+        with timing.stage("listing"):
+            if session is not None:
+                url = f"{repo.url}/contents/"
+                dir_contents = session.get_objects(ContentFile, url)
+            else:
+                dir_contents = repo.get_dir_contents("./")
+        path = match_file(fname, [x.path for x in dir_contents])
+        contents = next(x for x in dir_contents if x.path == path)
     else:
         contents = repo.get_contents(fname)
+    return contents
+
+
+def match_file(fname, paths):
+    """
+    match_file(fname, paths)
+
+    Returns the first of paths matching the regex fname or, failing that, the
+    first ipynb file. Returns None if there is neither.
+
+    Inputs
+    ------
+    fname : str
+    paths : list of str
+    """
+    try:
+        return next(x for x in paths if re.search(fname, x))
+    except StopIteration:
+        print(
+            f"No matches found using {fname}.\n"
+            "Weakening to look for any ipynb file."
+        )
+    return next((x for x in paths if re.search(".*ipynb", x)), None)
+
+
+def get_blob(repo, contents, blob_cache=None, session=None, throttle=False):
+    """
+    get_blob(repo, contents, blob_cache=None, session=None, throttle=False)
+
+    Returns the decoded content of the file described by contents (e.g., an
+    output of find_file_in_repo), from blob_cache if possible.
+
+    Inputs
+    ------
+    repo : Github repo object
+    contents : Github contents object
+    blob_cache : BlobCache or None
+    session : GitHubSession or None
+        If given, the blob is downloaded as raw bytes (cf. ghapi.get_raw_blob)
+        instead of being decoded from base64 JSON, and checked against its
+        SHA. Default: None
+    throttle : bool, float, TokenBucket or AdaptiveThrottle
+        Applied before the download, if it isn't made with session (which
+        applies its own). Default: False
+    """
+    if blob_cache is not None:
+        with timing.stage("cache") as info:
+            decoded_content = blob_cache.get(contents.sha)
+            if decoded_content is not None:
+                info["bytes"] = len(decoded_content)
+        if decoded_content is not None:
+            print(f"\tcached: {contents.name}")
+            return decoded_content
     print(f"\tfetching: {contents.name}")
-    blob = repo.get_git_blob(contents.sha)
-    decoded_content = base64.b64decode(bytearray(blob.content, "utf-8"))
+    if session is not None:
+        url = f"{repo.url}/git/blobs/{contents.sha}"
+        with timing.stage("download") as info:
+            decoded_content = ghapi.get_raw_blob(session, url)
+            info["bytes"] = len(decoded_content)
+        if cache.git_blob_sha(decoded_content) != contents.sha:
+            # e.g., a truncated download; an OSError is retried
+            raise IOError(f"{url} does not match its SHA")
+        if blob_cache is not None:
+            blob_cache.put(contents.sha, decoded_content)
+        return decoded_content
+    ratelimit.wait(throttle)
+    with timing.stage("download") as info:
+        blob = repo.get_git_blob(contents.sha)
+        info["bytes"] = len(blob.content)
+    with timing.stage("decode") as info:
+        decoded_content = base64.b64decode(bytearray(blob.content, "utf-8"))
+        info["bytes"] = len(decoded_content)
+    if blob_cache is not None:
+        blob_cache.put(contents.sha, decoded_content)
     return decoded_content
 
 
+def get_unchanged_file(gh, entry, blob_cache, throttle=False, session=None):
+    """
+    get_unchanged_file(gh, entry, blob_cache, throttle=False, session=None)
+
+    Uses a conditional request (If-None-Match with the repo's ETag from the
+    last run) to check whether a student's repo has changed since the fetch
+    recorded in entry. Returns the cached lab file if it has not; otherwise
+    returns None along with the up-to-date repo. A "304 Not Modified"
+    response does not count against the API rate limit.
+
+    Inputs
+    ------
+    gh : Github object
+    entry : dict
+        The student's entry of the fetch manifest (cf. fetch_lab_file)
+    blob_cache : BlobCache
+    throttle : bool, float or TokenBucket
+    session : GitHubSession or None
+        If given, the request is made with this session (which applies its
+        own throttle).
+
+    Returns
+    -------
+    lab : bytes or None
+    repo : Github repo object or None
+    """
+    if entry.get("etag") is None or entry["sha"] not in blob_cache:
+        return None, None
+    if session is None:
+        ratelimit.wait(throttle)
+    repo = gh.create_from_raw_data(
+        Repository,
+        {"url": entry["url"], "name": entry["repo"].split("/")[-1]},
+        headers={"etag": entry["etag"]},
+    )
+    with timing.stage("etag"):
+        if session is not None:
+            url = entry["url"]
+            changed = session.get_object(Repository, url, entry["etag"])
+            if changed is not None:
+                repo = changed
+        else:
+            changed = repo.update()
+    if changed:
+        print(f"Changed: {repo.name}")
+        return None, repo
+    lab = blob_cache.get(entry["sha"])
+    if lab is None:
+        return None, None
+    print(f"Unchanged: {repo.name}")
+    return lab, repo
+
+
+def discover_lab_files(
+    session,
+    base_url,
+    fname,
+    gid_list,
+    lab_num,
+    course_num,
+    year_tag=None,
+    throttle=False,
+    batch_size=50,
+):
+    """
+    discover_lab_files(session, base_url, fname, gid_list, lab_num,
+                       course_num, year_tag=None, throttle=False,
+                       batch_size=50)
+
+    Looks up the lab file matching fname in every student's repo at once,
+    using batched GraphQL queries (cf. ghapi.get_root_trees), so that
+    fetch_lab_file needn't call get_repo and list each repo. If the lookup
+    fails (e.g., a GitHub Enterprise without GraphQL, or a server error on
+    every try), None is returned, and every lab file is looked up one by one
+    instead.
+
+    Inputs
+    ------
+    session : GitHubSession
+    base_url : str
+        (e.g., https://github.ubc.ca/api/v3)
+    fname : str
+    gid_list : array
+    lab_num : str
+    course_num : str
+    year_tag : str or None
+    throttle : bool, float, TokenBucket or AdaptiveThrottle
+    batch_size : int
+        Number of repos per GraphQL query.
+
+    Returns
+    -------
+    discovered : dict or None
+        keys are the gids whose lab file was found; values are dicts with
+        keys "repo", "url", "path" and "sha" (cf. the fetch manifest)
+    """
+    if year_tag is None:
+        year_tag = "MDS-2019-20"
+    names = {f"DSCI_{course_num}_lab{lab_num}_{gid}": gid for gid in gid_list}
+    try:
+        with timing.stage("discovery"):
+            trees = ghapi.get_root_trees(
+                session,
+                ghapi.graphql_url(base_url),
+                year_tag,
+                list(names),
+                batch_size,
+                throttle,
+            )
+    except Exception as exc:
+        print(
+            f"Couldn't discover the lab files ({exc}); looking them up one "
+            "by one instead."
+        )
+        return None
+    discovered = {}
+    for name, tree in trees.items():
+        if tree is None:
+            continue
+        # (only files: the pattern may match a directory too, such as
+        # .ipynb_checkpoints)
+        blobs = {
+            x["name"]: x["oid"]
+            for x in tree["entries"]
+            if x.get("type") == "blob"
+        }
+        path = match_file(fname, list(blobs))
+        if path is None:
+            continue
+        discovered[names[name]] = {
+            "repo": tree["repo"],
+            "url": f"{base_url.rstrip('/')}/repos/{tree['repo']}",
+            "path": path,
+            "sha": blobs[path],
+        }
+    print(f"Discovered {len(discovered)} of {len(names)} lab files.")
+    return discovered
+
+
+def get_discovered_file(
+    gh, entry, blob_cache=None, throttle=False, session=None
+):
+    """
+    get_discovered_file(gh, entry, blob_cache=None, throttle=False,
+                        session=None)
+
+    Returns the lab file described by entry (cf. discover_lab_files), from
+    blob_cache if possible; otherwise with a single API call.
+
+    Inputs
+    ------
+    gh : Github object
+    entry : dict
+    blob_cache : BlobCache or None
+    throttle : bool, float, TokenBucket or AdaptiveThrottle
+    session : GitHubSession or None
+    """
+    repo = gh.create_from_raw_data(
+        Repository,
+        {
+            "url": entry["url"],
+            "name": entry["repo"].split("/")[-1],
+            "full_name": entry["repo"],
+        },
+    )
+    contents = gh.create_from_raw_data(
+        ContentFile,
+        {
+            "name": os.path.basename(entry["path"]),
+            "path": entry["path"],
+            "sha": entry["sha"],
+        },
+    )
+    print(f"Found: {repo.name}")
+    return get_blob(repo, contents, blob_cache, session, throttle)
+
+
+def fetch_lab_file(
+    gh,
+    fname,
+    gid,
+    lab_num,
+    course_num,
+    year_tag=None,
+    throttle=False,
+    blob_cache=None,
+    manifest=None,
+    discovered=None,
+    session=None,
+    num_tries=1,
+):
+    """
+    fetch_lab_file(gh, fname, gid, lab_num, course_num, year_tag=None,
+                   throttle=False, blob_cache=None, manifest=None,
+                   discovered=None, session=None, num_tries=1)
+
+    Returns the lab file matching fname from the repo of the student whose
+    GitHub ID is gid. The throttle is applied before each API call (by
+    session, if given), and each API call is retried on its own (cf.
+    ratelimit.call_with_retries), so that (e.g.) a failed download doesn't
+    repeat the repo lookup and listing before it.
+
+    If manifest has an entry for gid from an earlier run, the repo is only
+    listed and the lab only downloaded when the repo has changed since then
+    (cf. get_unchanged_file). manifest[gid] is then updated with the repo,
+    the path and blob SHA of the lab file, the repo's ETag and the time.
+
+    If discovered has an entry for gid, the lab file it describes is fetched
+    directly instead (cf. get_discovered_file).
+
+    Inputs
+    ------
+    gh : Github object
+    fname : str
+    gid : str
+    lab_num : str
+    course_num : str
+    year_tag : str or None
+    throttle : bool, float or TokenBucket
+    blob_cache : BlobCache or None
+    manifest : dict or None
+        (e.g., output of cache.load_manifest)
+    discovered : dict or None
+        (e.g., output of discover_lab_files)
+    session : GitHubSession or None
+        If given, every request is made with this session (and the lab is
+        downloaded as raw bytes, cf. get_blob). It should have the same
+        throttle.
+    num_tries : int
+        Max number of tries per API call.
+    """
+
+    def retry(func, *args):
+        return ratelimit.call_with_retries(
+            partial(func, *args), num_tries, throttle, label=gid
+        )
+
+    if discovered is not None and gid in discovered:
+        entry = discovered[gid]
+        lab = retry(
+            get_discovered_file, gh, entry, blob_cache, throttle, session
+        )
+        if manifest is not None:
+            # the repo's ETag is only still valid if the lab hasn't changed
+            previous = manifest.get(gid, {})
+            if previous.get("sha") == entry["sha"]:
+                etag = previous.get("etag")
+            else:
+                etag = None
+            manifest[gid] = {
+                **entry,
+                "etag": etag,
+                "fetched_at": time.time(),
+                "checked_at": time.time(),
+            }
+        return lab
+    repo = None
+    if manifest is not None and blob_cache is not None and gid in manifest:
+        lab, repo = retry(
+            get_unchanged_file,
+            gh,
+            manifest[gid],
+            blob_cache,
+            throttle,
+            session,
+        )
+        if lab is not None:
+            manifest[gid]["checked_at"] = time.time()
+            return lab
+    if repo is None:
+        repo = retry(
+            get_repo, gh, gid, lab_num, course_num, year_tag, throttle, session
+        )
+    if session is None:
+        ratelimit.wait(throttle)
+    contents = retry(find_file_in_repo, fname, repo, True, session)
+    lab = retry(get_blob, repo, contents, blob_cache, session, throttle)
+    if manifest is not None:
+        manifest[gid] = {
+            "repo": repo.full_name,
+            "url": repo.url,
+            "etag": repo.etag,
+            "path": contents.path,
+            "sha": contents.sha,
+            "fetched_at": time.time(),
+            "checked_at": time.time(),
+        }
+    return lab
+
+
 def fetch_lab_files(
-    gh, fname, gid_list, lab_num, course_num, year_tag=None, throttle=False
+    gh,
+    fname,
+    gid_list,
+    lab_num,
+    course_num,
+    year_tag=None,
+    throttle=False,
+    num_workers=1,
+    blob_cache=None,
+    manifest=None,
+    num_tries=1,
+    discovered=None,
+    session=None,
 ):
     """
     fetch_lab_files(gh, fname, gid_list, lab_num, course_num, year_tag=None,
-                    throttle=False)
+                    throttle=False, num_workers=1, blob_cache=None,
+                    manifest=None, num_tries=1, discovered=None,
+                    session=None)
 
     Attempts to return a lab for each student whose gid is in gid_list. Does
     this for lab number lab_num and course number course_num (with year_tag as
-    appropriate).
-
-    TODO: Need to check that all names are successfully fetched by
-    cross-referencing with gid_list afterward. Either re-try immediately,
-    or print out the names that were not fetch.
+    appropriate). A student whose lab can't be fetched is skipped (and listed
+    at the end), without affecting the other students.
 
     Inputs
     ------
@@ -177,28 +704,50 @@ def fetch_lab_files(
     lab_num : str
     course_num : str
     year_tag : str or None
-    throttle : bool or float
+    throttle : bool, float or TokenBucket
         Whether to slow down this function so that we're not blocked as a bot.
-        Default: False
-    """
-    labs = {}
-    if isinstance(gid_list, str) or not np.iterable(gid_list):
-        gid_list = [gid_list]
-    if not isinstance(lab_num, str):
-        lab_num = f"{lab_num}"
-    if not isinstance(course_num, str):
-        course_num = f"{course_num}"
+        When num_workers > 1, pass a TokenBucket to bound the combined request
+        rate of all workers. Default: False
+    num_workers : int
+        Number of students to fetch concurrently. Default: 1
+    blob_cache : BlobCache or None
+        Local cache of previously downloaded lab files. Default: None
+    manifest : dict or None
+        Record of each student's last fetch, updated in place; used with
+        blob_cache to skip repos that have not changed (cf. fetch_lab_file).
+        Default: None
+    num_tries : int
+        Max number of tries per API call (cf. ratelimit.call_with_retries).
+        Default: 1
+    discovered : dict or None
+        The lab file of each student, looked up in advance (cf.
+        discover_lab_files); students not in it are looked up one by one.
+        Default: None
+    session : GitHubSession or None
+        A pool of kept-alive connections shared by all workers; if given,
+        every request is made with it (cf. fetch_lab_file). Default: None
 
-    for gid in gid_list:
-        try:
-            labs[gid] = get_file_from_repo(
-                fname, get_repo(gh, gid, lab_num, course_num, year_tag)
-            )
-        except GithubException as ghe:
-            print(ghe)
-            print("Returning what we have so far...")
-            break
-    return labs
+    Returns
+    -------
+    labs : dict
+        keys are the successfully fetched gids, in the order of gid_list
+    """
+    lab_stream = stream_lab_files(
+        gh,
+        fname,
+        gid_list,
+        lab_num,
+        course_num,
+        year_tag,
+        num_tries,
+        throttle,
+        num_workers,
+        blob_cache,
+        manifest,
+        discovered,
+        session,
+    )
+    return {gid: lab for gid, lab in lab_stream if lab is not None}
 
 
 def persistent_fetch_lab_files(
@@ -210,6 +759,11 @@ def persistent_fetch_lab_files(
     year_tag=None,
     num_tries=5,
     throttle=False,
+    num_workers=1,
+    blob_cache=None,
+    manifest=None,
+    discovered=None,
+    session=None,
 ):
     """
     persistent_fetch_lab_files(
@@ -221,10 +775,18 @@ def persistent_fetch_lab_files(
         year_tag=None,
         num_tries=5,
         throttle=False,
+        num_workers=1,
+        blob_cache=None,
+        manifest=None,
+        discovered=None,
+        session=None,
     )
 
-    A wrapper around fetch_lab_files that tries a few times in case the
-    instance gets booted.
+    A wrapper around fetch_lab_files that tries each student a few times in
+    case the instance gets booted. Errors that are worth retrying (rate
+    limits, server and network errors) are retried with exponential backoff,
+    honouring Retry-After and X-RateLimit-Reset; a missing repo (404) is not
+    retried (cf. ratelimit.call_with_retries).
 
     Inputs
     ------
@@ -235,7 +797,12 @@ def persistent_fetch_lab_files(
     course_num : str
     year_tag : str or None
     num_tries : int
-    throttle : float or None
+    throttle : bool, float or TokenBucket
+    num_workers : int
+    blob_cache : BlobCache or None
+    manifest : dict or None
+    discovered : dict or None
+    session : GitHubSession or None
 
     Returns
     -------
@@ -243,34 +810,185 @@ def persistent_fetch_lab_files(
         keys matching gid_list, with entries that are strings of JSON objects,
         suitable to be passed to nbformat.reads(...)
     """
-    lab_files = fetch_lab_files(
-        gh, fname, gid_list, lab_num, course_num, year_tag, throttle
+    return fetch_lab_files(
+        gh,
+        fname,
+        gid_list,
+        lab_num,
+        course_num,
+        year_tag,
+        throttle,
+        num_workers,
+        blob_cache,
+        manifest,
+        num_tries,
+        discovered,
+        session,
     )
-    received_keys = np.array(list(lab_files.keys()))
-    missing_keys = np.setdiff1d(gid_list, received_keys)
-    for i in range(num_tries - 1):
-        print(f"Attempt {i + 2}")
-        time.sleep(1)
-        new_lab_files = fetch_lab_files(
-            gh, fname, missing_keys, lab_num, course_num, year_tag, throttle
-        )
-        for key, value in new_lab_files.items():
-            lab_files[key] = value
-        received_keys = np.array(list(lab_files.keys()))
-        missing_keys = np.setdiff1d(gid_list, received_keys)
-        if len(missing_keys) == 0:
-            break
+
+
+def stream_lab_files(
+    gh,
+    fname,
+    gid_list,
+    lab_num,
+    course_num,
+    year_tag=None,
+    num_tries=5,
+    throttle=False,
+    num_workers=1,
+    blob_cache=None,
+    manifest=None,
+    discovered=None,
+    session=None,
+):
+    """
+    stream_lab_files(gh, fname, gid_list, lab_num, course_num, year_tag=None,
+                     num_tries=5, throttle=False, num_workers=1,
+                     blob_cache=None, manifest=None, discovered=None,
+                     session=None)
+
+    Generates (gid, lab) for each gid in gid_list, in order, as the lab files
+    are fetched (by num_workers threads). At most 2 * num_workers lab files
+    are fetched ahead of the consumer, so memory use does not grow with the
+    size of gid_list.
+
+    Each API call is retried on its own (up to num_tries times in all, cf.
+    fetch_lab_file), so one missing repo or one throttled request doesn't
+    hold up, or re-fetch, anyone else (nor the calls already made for the
+    same student). If every try fails (or the error is permanent, e.g., a
+    404), lab is the lab file fetched for gid by an earlier run (as recorded
+    in manifest, if it is in blob_cache), or else None.
+
+    Inputs
+    ------
+    (cf. persistent_fetch_lab_files)
+
+    Yields
+    ------
+    gid : str
+    lab : bytes or None
+    """
+    if isinstance(gid_list, str) or not np.iterable(gid_list):
+        gid_list = [gid_list]
+    if not isinstance(lab_num, str):
+        lab_num = f"{lab_num}"
+    if not isinstance(course_num, str):
+        course_num = f"{course_num}"
+
+    def fetch(gid):
+        try:
+            with timing.student(gid):
+                return fetch_lab_file(
+                    gh,
+                    fname,
+                    gid,
+                    lab_num,
+                    course_num,
+                    year_tag,
+                    throttle,
+                    blob_cache,
+                    manifest,
+                    discovered,
+                    session,
+                    num_tries,
+                )
+        except Exception:
+            pass
+        if blob_cache is not None and manifest is not None and gid in manifest:
+            lab = blob_cache.get(manifest[gid]["sha"])
+            if lab is not None:
+                previous_keys.add(gid)
+            return lab
+        return None
+
+    missing_keys = []
+    previous_keys = set()
+    pending = deque()
+
+    def next_done():
+        key, future = pending.popleft()
+        lab = future.result()
+        if lab is None:
+            missing_keys.append(key)
+        return key, lab
+
+    num_workers = max(num_workers, 1)
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        for gid in gid_list:
+            pending.append((gid, executor.submit(fetch, gid)))
+            if len(pending) >= 2 * num_workers:
+                yield next_done()
+        while pending:
+            yield next_done()
+    if len(previous_keys) > 0:
+        print("-" * 50)
+        print("Couldn't fetch (used the lab file of an earlier run instead):")
+        print([gid for gid in gid_list if gid in previous_keys])
+        print("-" * 50)
     if len(missing_keys) > 0:
         print("-" * 50)
         print("Missing GitHub IDs:")
         print(missing_keys)
         print("-" * 50)
-    return lab_files
+    return
+
+
+def index_exercises(notebook, pattern=None):
+    """
+    index_exercises(notebook, pattern=None)
 
+    Scans the cells of notebook once and returns the start and end indices of
+    every exercise in it. Exercise n starts at the first markdown cell whose
+    heading matches pattern with exercise number n, and ends (exclusive) at
+    the first later heading cell whose exercise number is larger than n (or at
+    the end of the notebook). Mentions of earlier exercises, or sub-parts such
+    as "Exercise 3.1", do not end an exercise.
+
+    Inputs
+    ------
+    notebook : JSON-like
+        (e.g., output of nbformat.reads(lab_file))
+    pattern : str, compiled regex or None
+        A regex whose first group captures the exercise number.
+        Default: EXERCISE_PATTERN
 
-def get_cell_loc(notebook, exercise_number):
+    Returns
+    -------
+    cell_locs : dict
+        Maps each exercise number found to (a, b), so that
+        notebook["cells"][a:b] are the cells of that exercise.
+    """
+    if pattern is None:
+        pattern = EXERCISE_PATTERN
+    regex = re.compile(pattern)
+    cell_locs = {}
+    open_exercises = []
+    for i, cell in enumerate(notebook["cells"]):
+        if cell["cell_type"] != "markdown":
+            continue
+        cell_source = cell["source"]
+        if isinstance(cell_source, (list, tuple)):
+            cell_source = "".join(cell_source)
+        match = regex.search(cell_source)
+        if match is None:
+            continue
+        ex_num = int(match.group(1))
+        # A heading for a later exercise ends every earlier open exercise.
+        for open_num in [x for x in open_exercises if x < ex_num]:
+            cell_locs[open_num] = (cell_locs[open_num][0], i)
+            open_exercises.remove(open_num)
+        if ex_num not in cell_locs:
+            cell_locs[ex_num] = (i, None)
+            open_exercises.append(ex_num)
+    for open_num in open_exercises:
+        cell_locs[open_num] = (cell_locs[open_num][0], len(notebook["cells"]))
+    return cell_locs
+
+
+def get_cell_loc(notebook, exercise_number, pattern=None):
     """
-    get_cell_loc(notebook, exercise_number)
+    get_cell_loc(notebook, exercise_number, pattern=None)
 
     Returns two numbers (a,b), the start and end indices for the cells
     corresponding to the question (i.e., the exercise_number of the lab). For
@@ -278,50 +996,321 @@ def get_cell_loc(notebook, exercise_number):
     for Exercise 3 (the beginning of the problem statement) and b is the index
     for the first cell of Exercise 4.
 
+    To look up several exercises in the same notebook, call index_exercises
+    once instead.
+
     Inputs
     ------
     notebook : JSON-like
         (e.g., output of nbformat.reads(lab_file))
     exercise_number : int
         (e.g., 2)
+    pattern : str, compiled regex or None
+        (cf. index_exercises)
     """
-    a = -1
-    b = -1
-    pattern = r"\#+.*Exercise " + "{ex_num}"
-    for i, cell in enumerate(notebook["cells"]):
-        if cell["cell_type"] == "markdown":
-            if isinstance(cell["source"], (list, tuple)):
-                cell_source = "".join(cell["source"])
-            elif isinstance(cell["source"], str):
-                cell_source = cell["source"]
-
-            if len(cell_source) == 0:
-                pass
-            elif re.search(pattern.format(ex_num=exercise_number), cell_source):
-                a = i
-            elif re.search(
-                pattern.format(ex_num=exercise_number + 1), cell_source
-            ):
-                b = i
-        if (a > 0) and (b > 0):
-            # No need to search through cells once we've
-            # found what we're looking for.
-            break
-    if a == -1:
-        print("Error: get_cell_loc: a not found.")
-    elif b == -1:
-        print(
-            "Warning: get_cell_loc: b not found; using b = len(notebook['cells'])"
-        )
-        b = len(notebook["cells"])
-    elif a >= b:
-        print(f"Error: get_cell_loc: something went wrong: a = {a}, b = {b}")
-    return a, b
+    cell_locs = index_exercises(notebook, pattern)
+    if exercise_number not in cell_locs:
+        print(f"Error: get_cell_loc: Exercise {exercise_number} not found.")
+        return -1, -1
+    return cell_locs[exercise_number]
+
+
+def parse_lab(lab, pattern=None):
+    """
+    parse_lab(lab, pattern=None)
+
+    Parses and indexes lab once, so that any number of exercises can be
+    sliced out of it (see slice_lab) without re-reading the JSON.
+
+    Inputs
+    ------
+    lab : str
+        (e.g., an entry of the output of fetch_lab_files)
+    pattern : str, compiled regex or None
+        (cf. index_exercises)
+
+    Returns
+    -------
+    parsed_lab : tuple
+        (lab_fmt, cell_locs), where lab_fmt is the output of
+        nbformat.reads(lab) and cell_locs is the output of
+        index_exercises(lab_fmt, pattern).
+    """
+    with timing.stage("reads", nbytes=len(lab)):
+        lab_fmt = nbformat.reads(lab, as_version=4)
+    with timing.stage("index"):
+        cell_locs = index_exercises(lab_fmt, pattern)
+    return lab_fmt, cell_locs
+
+
+def slice_lab(parsed_lab, exercise_nums):
+    """
+    slice_lab(parsed_lab, exercise_nums)
+
+    Returns a notebook containing only the cells of parsed_lab corresponding
+    to the exercises in exercise_nums. The parsed notebook itself is left
+    unchanged.
+
+    Inputs
+    ------
+    parsed_lab : tuple
+        (e.g., output of parse_lab)
+    exercise_nums : list of int
+    """
+    lab_fmt, cell_locs = parsed_lab
+    cells = []
+    for ex_num in exercise_nums:
+        if ex_num not in cell_locs:
+            print(f"Error: slice_lab: Exercise {ex_num} not found.")
+            continue
+        a, b = cell_locs[ex_num]
+        cells += lab_fmt["cells"][a:b]
+    return nbformat.NotebookNode({**lab_fmt, "cells": cells})
+
+
+# Output images that extract_images saves to assets/, with their extensions
+IMAGE_EXTENSIONS = {
+    "image/png": ".png",
+    "image/jpeg": ".jpg",
+    "image/svg+xml": ".svg",
+}
+
+
+def extract_images(lab_fmt, save_dir):
+    """
+    extract_images(lab_fmt, save_dir)
+
+    Returns a copy of the notebook lab_fmt whose output images are saved to
+    {save_dir}assets/ and linked to (as assets/{hash}.png, etc.) rather than
+    embedded in the page as base64. Each image is named by a hash of its
+    content, so an image that many students produce is only saved once.
+
+    Inputs
+    ------
+    lab_fmt : NotebookNode
+        (e.g., output of slice_lab)
+    save_dir : str
+        The directory of the pages.
+    """
+    assets_dir = save_dir + "assets/"
+    if not os.path.exists(assets_dir):
+        os.makedirs(assets_dir)
+    # the slice shares its cells with the parsed lab, which must not change
+    lab_fmt = copy.deepcopy(lab_fmt)
+    for cell in lab_fmt.cells:
+        for output in cell.get("outputs", []):
+            data = output.get("data", {})
+            for mime, extension in IMAGE_EXTENSIONS.items():
+                if not data.get(mime):
+                    continue
+                if mime == "image/svg+xml":
+                    content = data[mime].encode("utf-8")
+                else:
+                    content = base64.b64decode(data[mime])
+                fname = hashlib.sha256(content).hexdigest()[:20] + extension
+                if not os.path.exists(assets_dir + fname):
+                    util.atomic_write(assets_dir + fname, content)
+                # the basic template links to these instead of the data
+                data[mime] = ""
+                if mime == "image/svg+xml":
+                    output["svg_filename"] = "assets/" + fname
+                else:
+                    metadata = output.setdefault("metadata", {})
+                    metadata.setdefault("filenames", {})[mime] = (
+                        "assets/" + fname
+                    )
+    return lab_fmt
+
+
+def make_html_exporter(include_css=True, fast=False):
+    """
+    make_html_exporter(include_css=True, fast=False)
+
+    Returns an HTMLExporter with the `basic` template. Creating the exporter
+    (and compiling its template) is slow, so one exporter should be re-used
+    for every student in a run.
+
+    Inputs
+    ------
+    include_css : bool
+        If False, the exporter does not regenerate the notebook CSS (in
+        resources["inlining"]["css"]) for every notebook it converts. The
+        body is the same either way; the CSS is written once by
+        write_css_files.
+    fast : bool
+        If True, return a fastrender.FastExporter instead, which renders
+        most cells without nbconvert (and the rest with the HTMLExporter).
+    """
+    c = Config({"CSSHTMLHeaderPreprocessor": {"enabled": include_css}})
+    html_exporter = HTMLExporter(config=c)
+    html_exporter.template_file = "basic"
+    if fast:
+        return fastrender.FastExporter(html_exporter)
+    return html_exporter
+
+
+@lru_cache(maxsize=None)
+def get_css():
+    """
+    get_css()
+
+    Returns the stylesheets used by the `basic` template, as a tuple of str.
+    They are only made (by exporting an empty notebook) once per run.
+    """
+    html_exporter = make_html_exporter(include_css=True)
+    _, resources = html_exporter.from_notebook_node(nbformat.v4.new_notebook())
+    return tuple(resources["inlining"]["css"])
+
+
+def write_css_files(save_dir):
+    """
+    write_css_files(save_dir)
+
+    Writes the CSS used by the `basic` template (cf. get_css) to save_dir as
+    style{i}.css (the stylesheets linked to by each page).
+
+    Inputs
+    ------
+    save_dir : str
+    """
+    for i, css_lines in enumerate(get_css()):
+        fname_css = save_dir + f"style{i}.css"
+        if os.path.exists(fname_css):
+            with open(fname_css, "r") as fp:
+                if fp.read() == css_lines:
+                    continue
+        util.atomic_write(fname_css, css_lines)
+        print("\t" + f"style{i}.css")
+    return
+
+
+# Exporter used by each process of the pool in render_notebooks
+_worker_exporter = None
+
+
+def _init_render_worker(fast=False):
+    global _worker_exporter
+    _worker_exporter = make_html_exporter(include_css=False, fast=fast)
+    return
+
+
+def _render_in_worker(lab_fmt):
+    return _export(_worker_exporter, lab_fmt)
+
+
+def _export(html_exporter, lab_fmt):
+    # Returns the html body of lab_fmt and the time it took to export
+    start = time.perf_counter()
+    body = html_exporter.from_notebook_node(lab_fmt)[0]
+    return body, time.perf_counter() - start
+
+
+def render_notebooks(
+    notebooks, html_exporter=None, num_jobs=1, with_times=False
+):
+    """
+    render_notebooks(notebooks, html_exporter=None, num_jobs=1,
+                     with_times=False)
+
+    Generates the html body of each notebook in notebooks, in order. With
+    num_jobs > 1, the notebooks are converted by a pool of num_jobs
+    processes (each with its own exporter, of the same kind as
+    html_exporter); only a few notebooks per process are in flight at any
+    time, so notebooks may be a generator.
+
+    Inputs
+    ------
+    notebooks : iterable of NotebookNode or None
+        (e.g., outputs of slice_lab). None is passed through as None (e.g.,
+        to mark the end of a page).
+    html_exporter : HTMLExporter, FastExporter or None
+        Used when num_jobs is 1. Default: make_html_exporter(False)
+    num_jobs : int
+    with_times : bool
+        If True, yield (body, seconds) instead, where seconds is the time it
+        took to export the notebook (in whichever process did it).
+
+    An entry of notebooks may also be a str, an already rendered body (e.g.,
+    from a RenderCache), which is yielded as is (with seconds None).
+
+    Yields
+    ------
+    body : HTML string
+    """
+    if num_jobs <= 1:
+        if html_exporter is None:
+            html_exporter = make_html_exporter(include_css=False)
+        for lab_fmt in notebooks:
+            if lab_fmt is None:
+                yield None
+            elif isinstance(lab_fmt, str):
+                yield (lab_fmt, None) if with_times else lab_fmt
+            else:
+                result = _export(html_exporter, lab_fmt)
+                yield result if with_times else result[0]
+        return
+
+    fast = isinstance(html_exporter, fastrender.FastExporter)
+    with ProcessPoolExecutor(
+        max_workers=num_jobs,
+        initializer=_init_render_worker,
+        initargs=(fast,),
+    ) as executor:
+        pending = deque()
+        for lab_fmt in notebooks:
+            if lab_fmt is None or isinstance(lab_fmt, str):
+                pending.append(lab_fmt)
+            else:
+                pending.append(executor.submit(_render_in_worker, lab_fmt))
+            if len(pending) >= 2 * num_jobs:
+                yield _next_result(pending, with_times)
+        while pending:
+            yield _next_result(pending, with_times)
+    return
+
+
+def _next_result(pending, with_times):
+    future = pending.popleft()
+    if future is None:
+        return None
+    if isinstance(future, str):
+        result = (future, None)
+    else:
+        result = future.result()
+    return result if with_times else result[0]
+
+
+def render_exercises(parsed_lab, exercise_nums, html_exporter=None):
+    """
+    render_exercises(parsed_lab, exercise_nums, html_exporter=None)
+
+    Generates html containing only the cells of parsed_lab corresponding to
+    the exercises in exercise_nums.
+
+    Inputs
+    ------
+    parsed_lab : tuple
+        (e.g., output of parse_lab)
+    exercise_nums : list of int
+    html_exporter : HTMLExporter or None
+        (e.g., output of make_html_exporter). Default: a new exporter.
+
+    Returns
+    -------
+    body : HTML string
+    resources: dict
+    """
+    lab_fmt = slice_lab(parsed_lab, exercise_nums)
+    if html_exporter is None:
+        html_exporter = make_html_exporter()
+
+    # Process the notebook we loaded earlier
+    return html_exporter.from_notebook_node(lab_fmt)
 
 
-def get_exercise_from_lab(lab, exercise_num, do_display=False):
+def get_exercise_from_lab(lab, exercise_num, do_display=False, pattern=None):
     """
-    get_exercise_from_lab(lab, exercise_num, do_display=False)
+    get_exercise_from_lab(lab, exercise_num, do_display=False, pattern=None)
 
     Takes lab, a string, and uses some nbformat magic to generate html
     containing only the cells corresponding to exercise_num. It displays this
@@ -336,22 +1325,16 @@ def get_exercise_from_lab(lab, exercise_num, do_display=False):
     lab : str
     exercise_num : int
     do_display : bool
+    pattern : str, compiled regex or None
+        (cf. index_exercises)
 
     Returns
     -------
     body : HTML string
     resources: dict
     """
-    lab_fmt = nbformat.reads(lab, as_version=4)
-    a, b = get_cell_loc(lab_fmt, exercise_num)
-    lab_fmt["cells"] = lab_fmt["cells"][a:b]
-
-    # Instantiate the exporter with the `basic` template
-    html_exporter = HTMLExporter()
-    html_exporter.template_file = "basic"
-
-    # Process the notebook we loaded earlier
-    (body, resources) = html_exporter.from_notebook_node(lab_fmt)
+    parsed_lab = parse_lab(lab, pattern)
+    (body, resources) = render_exercises(parsed_lab, [exercise_num])
 
     if do_display:
         display(HTML(body))
@@ -360,9 +1343,9 @@ def get_exercise_from_lab(lab, exercise_num, do_display=False):
     return
 
 
-def get_exercises_from_lab(lab, exercise_nums, do_display=False):
+def get_exercises_from_lab(lab, exercise_nums, do_display=False, pattern=None):
     """
-    get_exercises_from_lab(lab, exercise_nums, do_display=False)
+    get_exercises_from_lab(lab, exercise_nums, do_display=False, pattern=None)
 
     Takes lab + a list of the exercise numbers to return, and uses some nbformat
     magic to generate html containing only the cells corresponding to
@@ -377,23 +1360,16 @@ def get_exercises_from_lab(lab, exercise_nums, do_display=False):
     lab : str
     exercise_nums : list of int
     do_display : bool
+    pattern : str, compiled regex or None
+        (cf. index_exercises)
 
     Returns
     -------
     body : HTML string
     resources: dict
     """
-    lab_fmt = nbformat.reads(lab, as_version=4)
-    ab_list = [get_cell_loc(lab_fmt, ex_num) for ex_num in exercise_nums]
-    cells = sum([lab_fmt["cells"][a:b] for a, b in ab_list], [])
-    lab_fmt["cells"] = cells
-
-    # Instantiate the exporter with the `basic` template
-    html_exporter = HTMLExporter()
-    html_exporter.template_file = "basic"
-
-    # Process the notebook we loaded earlier
-    (body, resources) = html_exporter.from_notebook_node(lab_fmt)
+    parsed_lab = parse_lab(lab, pattern)
+    (body, resources) = render_exercises(parsed_lab, exercise_nums)
 
     if do_display:
         display(HTML(body))
@@ -402,21 +1378,267 @@ def get_exercises_from_lab(lab, exercise_nums, do_display=False):
     return
 
 
-def write_pages_to_files(
-    lab_files, gid_pages, exercise_num, lab_num, course_num, save_dir=None
+def page_inputs_hash(gid_page, lab_files, exercise_nums, pattern, settings):
+    """
+    page_inputs_hash(gid_page, lab_files, exercise_nums, pattern, settings)
+
+    Returns a hash of everything that a page's content depends on: the
+    GitHub IDs on the page with the blob SHAs of their lab files, the
+    exercise numbers, the exercise heading regex, and the exporter settings.
+    If the hash stored in an existing page matches, the page is up to date.
+
+    Inputs
+    ------
+    gid_page : list of str
+    lab_files : dict or mapping
+        (their SHAs are looked up with cache.lab_file_sha)
+    exercise_nums : list of int
+    pattern : str, compiled regex or None
+    settings : dict
+        (e.g., output of exporter_settings)
+    """
+    if pattern is None:
+        pattern = EXERCISE_PATTERN
+    blob_shas = [
+        cache.lab_file_sha(lab_files, gid) if gid in lab_files else None
+        for gid in gid_page
+    ]
+    inputs = {
+        "students": list(zip([f"{gid}" for gid in gid_page], blob_shas)),
+        "exercises": [int(x) for x in exercise_nums],
+        "pattern": getattr(pattern, "pattern", pattern),
+        "settings": settings,
+    }
+    inputs = json.dumps(inputs, sort_keys=True).encode("utf-8")
+    return hashlib.sha256(inputs).hexdigest()
+
+
+def exporter_settings(template_file="basic", assets=False, fast=False):
+    """
+    exporter_settings(template_file="basic", assets=False, fast=False)
+
+    Returns the settings that determine how make_html_exporter's exporter
+    renders a notebook (cf. page_inputs_hash), whether images are extracted
+    to assets/ (cf. extract_images), and whether the fast renderer is used
+    (cf. fastrender.FastExporter).
+    """
+    settings = {
+        "template_file": template_file,
+        "nbconvert": nbconvert.__version__,
+        "assets": assets,
+    }
+    if fast:
+        # only recorded if set, so that pages written before are kept
+        settings["fastrender"] = fastrender.VERSION
+    return settings
+
+
+def read_page_header(fname):
+    """
+    read_page_header(fname)
+
+    Returns the inputs hash and the GitHub IDs of the students whose lab
+    files were missing, as recorded in the first line of the page fname by
+    write_pages_to_files.
+
+    Returns
+    -------
+    inputs_hash : str or None
+        None if there is no such page.
+    missing : list of str or None
+        None if not recorded (e.g., for a page written by an earlier version)
+    """
+    try:
+        with open(fname, "r") as fp:
+            first_line = fp.readline()
+    except FileNotFoundError:
+        return None, None
+    match = re.match(
+        r"<!-- inputs: ([0-9a-f]+)(?: missing: (\[.*\]))? -->", first_line
+    )
+    if match is None:
+        return None, None
+    missing = None if match.group(2) is None else json.loads(match.group(2))
+    return match.group(1), missing
+
+
+# Loads each fragment of an index page (cf. write_fragment_index) when it is
+# scrolled near. Where fetch isn't allowed (e.g., for a page opened from
+# file://), the fragment is shown in an iframe instead.
+FRAGMENT_LOADER_JS = """
+function loadFragment(div) {
+    var src = div.getAttribute("data-src");
+    div.removeAttribute("data-src");
+    fetch(src)
+        .then(function (response) {
+            if (!response.ok) {
+                throw new Error(response.statusText);
+            }
+            return response.text();
+        })
+        .then(function (text) {
+            var doc = new DOMParser().parseFromString(text, "text/html");
+            div.innerHTML = doc.body.innerHTML;
+        })
+        .catch(function () {
+            var frame = document.createElement("iframe");
+            frame.src = src;
+            frame.style.width = "100%";
+            frame.style.border = "0";
+            frame.onload = function () {
+                var doc = frame.contentDocument;
+                var height = doc ? doc.body.scrollHeight + 40 : 600;
+                frame.style.height = height + "px";
+            };
+            div.innerHTML = "";
+            div.appendChild(frame);
+        });
+}
+var fragments = document.querySelectorAll("div.fragment[data-src]");
+if ("IntersectionObserver" in window) {
+    var observer = new IntersectionObserver(function (entries) {
+        entries.forEach(function (entry) {
+            if (entry.isIntersecting) {
+                observer.unobserve(entry.target);
+                loadFragment(entry.target);
+            }
+        });
+    }, {rootMargin: "1000px"});
+    fragments.forEach(function (div) { observer.observe(div); });
+} else {
+    fragments.forEach(loadFragment);
+}
+"""
+
+
+def write_fragment_index(fname, gid_list, found_gids, fname_fragment, title):
+    """
+    write_fragment_index(fname, gid_list, found_gids, fname_fragment, title)
+
+    Writes an index page to fname with a heading for each student in
+    gid_list, under which their fragment (fname_fragment.format(gid=gid)) is
+    loaded once it is scrolled near (cf. FRAGMENT_LOADER_JS). The page is
+    only rewritten if it changed.
+
+    Inputs
+    ------
+    fname : str
+    gid_list : list of str
+    found_gids : set of str
+        The students who have a fragment; the others are marked as missing.
+    fname_fragment : str
+        Path of the fragments relative to the index page, with a {gid} field.
+    title : str
+    """
+    page = [
+        "<head>\n"
+        '\t<meta charset="utf-8">\n'
+        f"\t<title>{html.escape(title)}</title>\n"
+        '\t<link rel="stylesheet" href="style0.css">\n'
+        '\t<link rel="stylesheet" href="style1.css">\n'
+        "\t<style>div.fragment { min-height: 10em; }</style>"
+        "\n</head>\n"
+        "\n<body>\n\n"
+    ]
+    for gid in gid_list:
+        gid_str = html.escape(f"{gid}")
+        page.append(f'\n<h1 id="{gid_str}">{gid_str}</h1>\n')
+        if gid in found_gids:
+            src = html.escape(fname_fragment.format(gid=gid))
+            page.append(f'<div class="fragment" data-src="{src}">...</div>\n')
+        else:
+            page.append("<p>(lab file not found)</p>\n")
+    page.append(f"\n<script>{FRAGMENT_LOADER_JS}</script>\n</body>")
+    page = "".join(page)
+    if os.path.exists(fname):
+        with open(fname, "r") as fp:
+            if fp.read() == page:
+                return
+    util.atomic_write(fname, page)
+    print("\t" + f"{os.path.basename(fname)} ({len(found_gids)} fragments)")
+    return
+
+
+def write_pages(
+    pages,
+    exercise_num,
+    lab_num,
+    course_num,
+    save_dir=None,
+    parsed_labs=None,
+    pattern=None,
+    html_exporter=None,
+    num_jobs=1,
+    force=False,
+    assets=False,
+    fragments=False,
+    label=None,
+    sizes=None,
+    render_cache=None,
 ):
     """
-    write_pages_to_files(lab_files, gid_pages, exercise_num, lab_num,
-                         course_num, save_dir=None)
+    write_pages(pages, exercise_num, lab_num, course_num, save_dir=None,
+                parsed_labs=None, pattern=None, html_exporter=None,
+                num_jobs=1, force=False, assets=False, fragments=False,
+                label=None, sizes=None, render_cache=None)
+
+    Writes one HTML page for each (page_number, gid_page, page_labs) in pages,
+    along with the CSS files. pages may be a generator: each page is written
+    as soon as its students have been rendered, and its lab files are then
+    no longer needed.
+
+    Each page records a hash of its inputs (cf. page_inputs_hash) in its
+    first line. A page whose inputs have not changed since it was written is
+    skipped; any other page is rendered and then written atomically, so that
+    re-running never leaves a partial (or doubled-up) page behind.
 
     Inputs
     ------
-    lab_files : list
-    gid_pages : dict of lists
+    pages : iterable of tuples
+        (page_number, gid_page, page_labs), where gid_page is a list of
+        GitHub IDs and page_labs is a dict (or any mapping) with their lab
+        files (cf. write_pages_to_files and stream_pages_to_files).
     exercise_num : int or list of ints
     lab_num : string
     course_num : string
     save_dir : string
+    parsed_labs : dict or None
+        If a dict, maps gid to the output of parse_lab(page_labs[gid]).
+        Each lab is parsed at most once and added to parsed_labs, so passing
+        the same dict to several calls (e.g., one per exercise) re-uses the
+        parsed notebooks. Default: None (don't keep the parsed notebooks).
+    pattern : str, compiled regex or None
+        Regex for exercise headings (cf. index_exercises).
+    html_exporter : HTMLExporter, FastExporter or None
+        The exporter used for every student (cf. make_html_exporter).
+        Default: one new exporter for this call.
+    num_jobs : int
+        Number of processes used to render the students' answers (cf.
+        render_notebooks). The pages are the same for any num_jobs.
+    force : bool
+        If True, rewrite every page, whether or not its inputs changed.
+    assets : bool
+        If True, output images are saved to {save_dir}assets/ and linked to
+        from the pages, instead of being embedded (cf. extract_images).
+    fragments : bool
+        If True, write each student's answer to its own fragment,
+        fragments/exercise{n}/{gid}.html (skipped if its inputs haven't
+        changed), and one index page, DSCI{course}_lab{lab}_exercise{n}.html,
+        that loads the fragments as they are scrolled to (cf.
+        write_fragment_index), instead of the paginated pages.
+    label : str or None
+        If given (e.g., a section or a TA, cf. roster.Roster.groups), it is
+        added to the names of the pages (or of the index page), as
+        DSCI{course}_lab{lab}_{label}_exercise{n}..., so that several groups'
+        pages can be written to the same save_dir.
+    sizes : dict or None
+        If given, the size in bytes of each student's rendered answer is
+        recorded in it, by gid (cf. roster.make_pages).
+    render_cache : RenderCache or None
+        If given, a student's answer that was rendered before (from the same
+        lab file, for the same exercises and exporter settings) is taken
+        from it instead of being parsed and rendered again, and new
+        renderings are saved to it (cf. cache.RenderCache).
 
     Output
     ------
@@ -424,13 +1646,15 @@ def write_pages_to_files(
     """
     if save_dir is None:
         save_dir = "./"
+    if html_exporter is None:
+        html_exporter = make_html_exporter(include_css=False)
 
     if isinstance(exercise_num, (list, tuple)) and (len(exercise_num) != 1):
         exercise_num_str = "".join([f"{x}" for x in exercise_num])
-        parser = get_exercises_from_lab
+        exercise_nums = list(exercise_num)
     elif isinstance(exercise_num, np.int):
         exercise_num_str = f"{exercise_num}"
-        parser = get_exercise_from_lab
+        exercise_nums = [exercise_num]
     else:
         print(
             f"Attempting type coercion of exercise_num {exercise_num} "
@@ -438,122 +1662,465 @@ def write_pages_to_files(
         )
         exercise_num = int(exercise_num)
         exercise_num_str = f"{exercise_num}"
-        parser = get_exercise_from_lab
+        exercise_nums = [exercise_num]
 
     if not isinstance(lab_num, str):
         lab_num = f"{lab_num}"
     if not isinstance(course_num, str):
         course_num = f"{course_num}"
 
-    fname_html = f"DSCI{course_num}_lab{lab_num}_exercise{exercise_num_str}"
+    if label is None:
+        fname_html = f"DSCI{course_num}_lab{lab_num}_"
+    else:
+        label = re.sub(r"[^\w.-]+", "_", f"{label}")
+        fname_html = f"DSCI{course_num}_lab{lab_num}_{label}_"
+    fname_html = fname_html + f"exercise{exercise_num_str}"
+    fname_index = fname_html + ".html"
+    fname_fragment = f"fragments/exercise{exercise_num_str}/" + "{gid}.html"
     fname_html = fname_html + "_page{page_number}.html"
+    if fragments:
+        fragment_dir = os.path.dirname(save_dir + fname_fragment)
+        if not os.path.exists(fragment_dir):
+            os.makedirs(fragment_dir)
+        # fragments are a directory deeper than the CSS and assets
+        base = '\t<base href="../../">\n'
+    else:
+        base = ""
+
+    settings = exporter_settings(
+        assets=assets,
+        fast=isinstance(html_exporter, fastrender.FastExporter),
+    )
+    page_infos = deque()
+    index_gids = []
+    found_gids = set()
+
+    def slice_student(page_labs, gid):
+        # Returns the student's slice to render (or, if it was rendered
+        # before, the rendering) and its key in render_cache (None if the
+        # rendering was cached, or there is no cache)
+        key = None
+        if render_cache is not None:
+            with timing.stage("cached"):
+                key = cache.render_key(
+                    cache.lab_file_sha(page_labs, gid),
+                    exercise_nums,
+                    EXERCISE_PATTERN if pattern is None else pattern,
+                    settings,
+                )
+                body = render_cache.get(key)
+            if body is not None:
+                return body, None
+        if parsed_labs is None:
+            parsed_lab = parse_lab(page_labs[gid], pattern)
+        elif gid in parsed_labs:
+            parsed_lab = parsed_labs[gid]
+        else:
+            parsed_lab = parse_lab(page_labs[gid], pattern)
+            parsed_labs[gid] = parsed_lab
+        with timing.stage("slice"):
+            lab_fmt = slice_lab(parsed_lab, exercise_nums)
+        if assets:
+            with timing.stage("assets"):
+                lab_fmt = extract_images(lab_fmt, save_dir)
+        return lab_fmt, key
+
+    def sliced_labs():
+        # Yields each student's slice, then None at the end of each page (or
+        # of each fragment). Only the pages whose inputs changed are rendered.
+        for page_number, gid_page, page_labs in pages:
+            if fragments:
+                units = [
+                    (fname_fragment.format(gid=gid), [gid]) for gid in gid_page
+                ]
+                index_gids.extend(gid_page)
+                found_gids.update(gid for gid in gid_page if gid in page_labs)
+            else:
+                fname_page = fname_html.format(page_number=page_number)
+                units = [(fname_page, gid_page)]
+            for fname_page, gid_unit in units:
+                inputs_hash = page_inputs_hash(
+                    gid_unit, page_labs, exercise_nums, pattern, settings
+                )
+                saved_hash, saved_missing = read_page_header(
+                    save_dir + fname_page
+                )
+                is_unchanged = (not force) and (saved_hash == inputs_hash)
+                found = [gid in page_labs for gid in gid_unit]
+                # Keep a page rather than lose the answers of students whose
+                # lab files are missing this time but were on it
+                if not (force or is_unchanged) and saved_missing is not None:
+                    lost = [
+                        gid
+                        for gid, is_found in zip(gid_unit, found)
+                        if not is_found and gid not in saved_missing
+                    ]
+                    if len(lost) > 0:
+                        print(
+                            f"\tKept {fname_page}: {lost} not found this "
+                            "time (pass --force to rewrite it without them)."
+                        )
+                        is_unchanged = True
+                        if fragments:
+                            found_gids.update(lost)
+                keys = []
+                if not is_unchanged:
+                    for gid in gid_unit:
+                        if gid not in page_labs:
+                            continue
+                        with timing.student(gid):
+                            lab_fmt, key = slice_student(page_labs, gid)
+                        keys.append(key)
+                        yield lab_fmt
+                page_infos.append(
+                    (
+                        fname_page,
+                        gid_unit,
+                        found,
+                        inputs_hash,
+                        is_unchanged,
+                        keys,
+                    )
+                )
+                yield None
 
     # Write paginated HTML pages
     print(f"Writing to {save_dir}:")
-    for page_number, gid_page in gid_pages.items():
-        fname_page = fname_html.format(page_number=page_number)
-        fp = open(save_dir + fname_page, "a")
-        fp.write(
+    num_unchanged = 0
+    page_bodies = []
+    for result in render_notebooks(
+        sliced_labs(), html_exporter, num_jobs, with_times=True
+    ):
+        if result is not None:
+            page_bodies.append(result)
+            continue
+        fname_page, gid_page, found, inputs_hash, is_unchanged, keys = (
+            page_infos.popleft()
+        )
+        if is_unchanged:
+            num_unchanged += 1
+            continue
+        if fragments and not any(found):
+            print(f"gid {gid_page[0]} not found in lab_files.keys().")
+            continue
+        bodies = iter(page_bodies)
+        keys = iter(keys)
+        missing = [
+            f"{gid}" for gid, is_found in zip(gid_page, found) if not is_found
+        ]
+        page = [
+            f"<!-- inputs: {inputs_hash} missing: {json.dumps(missing)} -->\n"
             "<head>\n"
+            f"{base}"
             '\t<link rel="stylesheet" href="style0.css">\n'
             '\t<link rel="stylesheet" href="style1.css">'
             "\n</head>\n"
             "\n<body>\n\n"
-        )
-        for gid in gid_page:
-            if gid not in lab_files:
+        ]
+        for gid, is_found in zip(gid_page, found):
+            if not is_found:
                 print(f"gid {gid} not found in lab_files.keys().")
             else:
-                fp.write(f"\n\n<h1>{gid}</h1>\n\n")
-                fp.write(
-                    parser(lab_files[gid], exercise_num, do_display=False)[0]
-                )
-        fp.write("</body>")
-        fp.close()
-        print("\t" + f"{fname_page}")
+                # (the index page has the headings of the fragments)
+                if not fragments:
+                    page.append(f"\n\n<h1>{gid}</h1>\n\n")
+                body, seconds = next(bodies)
+                key = next(keys)
+                if seconds is not None:
+                    timing.add("export", seconds, gid, len(body))
+                if key is not None:
+                    render_cache.put(key, body)
+                if sizes is not None:
+                    sizes[gid] = len(body)
+                page.append(body)
+        page.append("</body>")
+        page = "".join(page)
+        with timing.stage("write", fname_page, len(page)):
+            util.atomic_write(save_dir + fname_page, page)
+        if not fragments:
+            print("\t" + f"{fname_page}")
+        page_bodies = []
+    if num_unchanged > 0:
+        unit = "fragments" if fragments else "pages"
+        print(f"\t({num_unchanged} {unit} unchanged)")
+    if fragments:
+        title = (
+            f"DSCI {course_num} Lab {lab_num}, "
+            f"Exercise {', '.join(f'{x}' for x in exercise_nums)}"
+        )
+        write_fragment_index(
+            save_dir + fname_index,
+            index_gids,
+            found_gids,
+            fname_fragment,
+            title,
+        )
     # Write the CSS files to the same folder
-    _, resources = parser(
-        list(lab_files.values())[0], exercise_num, do_display=False
-    )
     print()
-    for i, css_lines in enumerate(resources["inlining"]["css"]):
-        with open(save_dir + f"style{i}.css", "w") as fp:
-            fp.write(css_lines)
-        print("\t" + f"style{i}.css")
+    write_css_files(save_dir)
     return
 
 
-def load_ghpw(uname):
-    if uname == "aberk":
-        with open("ghubcmds.pw", "r") as fp:
-            return fp.readline()
-    else:
-        raise ValueError(f"uname {uname} not recognized.")
+def write_pages_to_files(
+    lab_files,
+    gid_pages,
+    exercise_num,
+    lab_num,
+    course_num,
+    save_dir=None,
+    parsed_labs=None,
+    pattern=None,
+    html_exporter=None,
+    num_jobs=1,
+    force=False,
+    assets=False,
+    fragments=False,
+    label=None,
+    sizes=None,
+    render_cache=None,
+):
+    """
+    write_pages_to_files(lab_files, gid_pages, exercise_num, lab_num,
+                         course_num, save_dir=None, parsed_labs=None,
+                         pattern=None, html_exporter=None, num_jobs=1,
+                         force=False, assets=False, fragments=False,
+                         label=None, sizes=None, render_cache=None)
+
+    Writes the pages in gid_pages from the lab files in lab_files (cf.
+    write_pages for the remaining inputs).
+
+    Inputs
+    ------
+    lab_files : dict or mapping
+        (e.g., a MappedArchive)
+    gid_pages : dict of lists
+    exercise_num : int or list of ints
+    lab_num : string
+    course_num : string
+    save_dir : string
+
+    Output
+    ------
+    Saves several files to save_dir (default save_dir is './')
+    """
+    pages = (
+        (page_number, gid_page, lab_files)
+        for page_number, gid_page in gid_pages.items()
+    )
+    write_pages(
+        pages,
+        exercise_num,
+        lab_num,
+        course_num,
+        save_dir,
+        parsed_labs,
+        pattern,
+        html_exporter,
+        num_jobs,
+        force,
+        assets,
+        fragments,
+        label,
+        sizes,
+        render_cache,
+    )
     return
 
 
-if __name__ == "__main__":
-    args = util.parser.parse_args()
+def group_into_pages(lab_stream, gid_pages):
+    """
+    group_into_pages(lab_stream, gid_pages)
 
-    gh_uname = args.uname
-    course_num = args.course
-    lab_num = args.lab
-    exercise_num = args.exercise
-    fname = args.fname
-    gid_filepath = args.gidpath
-    section = args.section
-    throttle = args.throttle
-    spp = args.studentsperpage
-    doSave = args.doSave
+    Collects the (gid, lab) pairs of lab_stream into pages, yielding
+    (page_number, gid_page, page_labs) as soon as every student on a page
+    has arrived. Students whose lab is None are left off page_labs. If
+    lab_stream follows the order of gid_pages, only one page of lab files is
+    held at a time.
 
-    assert gh_uname is not None, f"Expected gh_uname but found None"
-    assert course_num is not None, f"Expected course_num but found None"
-    assert lab_num is not None, f"Expected lab_num but found None"
+    Inputs
+    ------
+    lab_stream : iterable of tuples
+        (e.g., output of stream_lab_files)
+    gid_pages : dict of lists
+    """
+    lab_stream = iter(lab_stream)
+    arrived = {}
+    for page_number, gid_page in gid_pages.items():
+        for gid in gid_page:
+            while gid not in arrived:
+                try:
+                    key, lab = next(lab_stream)
+                except StopIteration:
+                    break
+                arrived[key] = lab
+        page_labs = {}
+        for gid in gid_page:
+            lab = arrived.pop(gid, None)
+            if lab is not None:
+                page_labs[gid] = lab
+        yield page_number, gid_page, page_labs
+    # Let lab_stream finish (e.g., to report any missing GitHub IDs)
+    for _ in lab_stream:
+        pass
+    return
 
-    # Parse exercise_num correctly
-    exercise_num = util.format_exercise_num(exercise_num)
 
-    # Default filename
-    if fname is None:
-        fname = f".*lab.?{lab_num}.*ipynb"
+def stream_pages_to_files(
+    lab_stream,
+    gid_pages,
+    exercise_num,
+    lab_num,
+    course_num,
+    save_dir=None,
+    pattern=None,
+    html_exporter=None,
+    num_jobs=1,
+    force=False,
+    assets=False,
+    fragments=False,
+    label=None,
+    sizes=None,
+    render_cache=None,
+):
+    """
+    stream_pages_to_files(lab_stream, gid_pages, exercise_num, lab_num,
+                          course_num, save_dir=None, pattern=None,
+                          html_exporter=None, num_jobs=1, force=False,
+                          assets=False, fragments=False, label=None,
+                          sizes=None, render_cache=None)
 
-    util.print_info(
-        gh_uname,
-        course_num,
-        lab_num,
+    Like write_pages_to_files, but takes the lab files from lab_stream as
+    they arrive (e.g., while later students are still being fetched), and
+    writes each page as soon as its students are in.
+
+    Inputs
+    ------
+    lab_stream : iterable of tuples
+        (gid, lab) pairs (e.g., output of stream_lab_files)
+    gid_pages : dict of lists
+    (cf. write_pages for the remaining inputs)
+    """
+    write_pages(
+        group_into_pages(lab_stream, gid_pages),
         exercise_num,
-        fname,
-        gid_filepath,
-        section,
-        throttle,
-        spp,
+        lab_num,
+        course_num,
+        save_dir,
+        None,
+        pattern,
+        html_exporter,
+        num_jobs,
+        force,
+        assets,
+        fragments,
+        label,
+        sizes,
+        render_cache,
     )
+    return
 
-    # Classy CSV should be the CSV file containing all of the github ids
-    gid_df = pd.read_csv(gid_filepath)  # pd.read_csv("./classy.csv")
-    if section is not None:
-        gid_df = gid_df.loc[
-            gid_df.filter(regex="[Ss]ection").values.ravel() == section
-        ]
-    gid_list = gid_df.id0.values
 
-    num_pages = gid_list.size // spp + 1
-    gid_pages = {
-        page: gid_list[spp * page : (spp * page + spp)]
-        for page in range(num_pages)
-    }
+def run_lab(
+    course_num,
+    lab_num,
+    outputs,
+    args,
+    class_roster,
+    gh=None,
+    session=None,
+    throttle=False,
+):
+    """
+    run_lab(course_num, lab_num, outputs, args, class_roster, gh=None,
+            session=None, throttle=False)
+
+    Writes the pages of every output of one lab (cf. batch.load_job). The
+    lab files of all the outputs' students are fetched once (or, with
+    args.offline, read from those saved by a previous run), and each
+    student's lab file is parsed once for all of the exercises written for
+    their group.
+
+    Inputs
+    ------
+    course_num : str
+    lab_num : str
+    outputs : list of dicts
+        (cf. batch.normalize_output), all for this lab
+    args : Namespace
+        The flags (output of util.parser.parse_args)
+    class_roster : roster.Roster
+    gh : Github object or None
+        (None if args.offline)
+    session : GitHubSession or None
+        (None if args.offline)
+    throttle : bool, float, TokenBucket or AdaptiveThrottle
+        (cf. get_repo)
+
+    Output
+    ------
+    Saves the pages to ./DSCI{course_num}/Lab{lab_num}/
+    """
+    fname = args.fname
+    if fname is None:
+        fname = f".*lab.?{lab_num}.*ipynb"
 
-    # initialize github instance
-    password = load_ghpw(gh_uname)
-    gh = Github(
-        login_or_token=gh_uname,
-        password=password,
-        base_url="https://github.ubc.ca/api/v3",
+    # The groups of students to write pages for (each section or TA, cf.
+    # roster.Roster.groups), with the exercises to write for each group
+    # (in a batch, the pages of each output's sections are labelled with
+    # their names, so that two outputs' pages never have the same names)
+    group_exercises = {}
+    page_gids = {}
+    for output in outputs:
+        assignments = None
+        if output["assignments"] is not None:
+            assignments = roster.read_assignments(output["assignments"])
+        groups = class_roster.groups(
+            output["sections"],
+            assignments,
+            output["ta"],
+            label_sections=args.batch is not None,
+        )
+        for label, gids in groups.items():
+            exercises = group_exercises.setdefault((label, tuple(gids)), [])
+            for exercise_num in output["exercises"]:
+                # pages are named by label and exercise
+                name = (label, roster.exercise_key(exercise_num))
+                if page_gids.setdefault(name, tuple(gids)) != tuple(gids):
+                    raise ValueError(
+                        f"Two groups of different students in lab {lab_num} "
+                        f"are both labelled {label}, for exercise "
+                        f"{exercise_num}; their pages would overwrite each "
+                        "other."
+                    )
+                if exercise_num not in exercises:
+                    exercises.append(exercise_num)
+    if len(group_exercises) == 0:
+        raise ValueError(
+            f"No students to write pages for in lab {lab_num} (cf. the "
+            "sections, assignments and TAs of its outputs)."
+        )
+    # every group's students are fetched at once
+    gid_list = class_roster.union(
+        {key: np.asarray(key[1], dtype=object) for key in group_exercises}
     )
 
-    # download lab files
-    lab_files = persistent_fetch_lab_files(
-        gh, fname, gid_list, lab_num, course_num, throttle=throttle
+    labels = [label for label, _ in group_exercises if label is not None]
+    all_exercises = []
+    for exercises in group_exercises.values():
+        for exercise_num in exercises:
+            if exercise_num not in all_exercises:
+                all_exercises.append(exercise_num)
+    util.print_info(
+        args.uname,
+        course_num,
+        lab_num,
+        all_exercises if len(all_exercises) > 1 else all_exercises[0],
+        fname,
+        args.gidpath,
+        labels if len(labels) > 0 else None,
+        throttle,
+        args.studentsperpage,
+        args.workers,
     )
 
     # set and create directory
@@ -561,16 +2128,252 @@ if __name__ == "__main__":
     if not os.path.exists(save_dir):
         os.makedirs(save_dir)
 
-    # Useful in case something goes wrong.
-    if doSave is True:
-        util.save_files(save_dir, lab_files)
+    # notebooks downloaded by earlier runs are looked up by blob SHA
+    if args.nocache:
+        blob_cache = None
+    else:
+        blob_cache = cache.BlobCache(save_dir + "blobs/")
+    manifest_fname = save_dir + "manifest.json"
+    manifest = cache.load_manifest(manifest_fname)
+
+    # answers rendered by earlier runs are looked up by lab file, exercises
+    # and exporter settings
+    if args.rendercache > 0:
+        render_cache = cache.RenderCache(
+            save_dir + "renders/", args.rendercache * 1e6
+        )
+    else:
+        render_cache = None
+
+    # Split each group into pages, balanced by the size of each student's
+    # answers (to the largest of the group's exercises) in an earlier run if
+    # --pagesize is given
+    sizes_fname = save_dir + "sizes.json"
+    all_sizes = roster.load_sizes(sizes_fname)
+    max_size = None if args.pagesize is None else args.pagesize * 1e6
+    group_pages = {}
+    for key, exercises in group_exercises.items():
+        known_sizes = {}
+        for exercise_num in exercises:
+            sizes = all_sizes.get(roster.exercise_key(exercise_num), {})
+            for gid, size in sizes.items():
+                known_sizes[gid] = max(size, known_sizes.get(gid, 0))
+        group_pages[key] = roster.make_pages(
+            np.asarray(key[1], dtype=object),
+            args.studentsperpage,
+            known_sizes,
+            max_size,
+        )
 
-    # write exercises to HTML pages
-    write_pages_to_files(
-        lab_files,
-        gid_pages,
-        exercise_num,
+    # one exporter for every page
+    html_exporter = make_html_exporter(include_css=False, fast=args.fast)
+
+    def write_groups(lab_files):
+        # each group's lab files are parsed once, for all of its exercises
+        for key, exercises in group_exercises.items():
+            parsed_labs = {}
+            for exercise_num in exercises:
+                write_pages_to_files(
+                    lab_files,
+                    group_pages[key],
+                    exercise_num,
+                    lab_num,
+                    course_num,
+                    save_dir=save_dir,
+                    parsed_labs=parsed_labs,
+                    pattern=args.pattern,
+                    html_exporter=html_exporter,
+                    num_jobs=args.jobs,
+                    force=args.force,
+                    assets=args.assets,
+                    fragments=args.fragments,
+                    label=key[0],
+                    sizes=all_sizes.setdefault(
+                        roster.exercise_key(exercise_num), {}
+                    ),
+                    render_cache=render_cache,
+                )
+        return
+
+    if args.offline:
+        # re-render from the lab files saved by a previous run
+        # (each student's lab file is only read when their page is written)
+        if blob_cache is not None and len(manifest) > 0:
+            lab_files = cache.CachedLabFiles(manifest, blob_cache, gid_list)
+        else:
+            lab_files = archive.map_files(save_dir, gid_list)
+        try:
+            write_groups(lab_files)
+        finally:
+            roster.save_sizes(sizes_fname, all_sizes)
+            if render_cache is not None:
+                render_cache.evict()
+        return
+
+    # Look up every student's lab file in a few batched queries
+    discovered = None
+    if args.discover:
+        discovered = discover_lab_files(
+            session,
+            session.base_url,
+            fname,
+            gid_list,
+            lab_num,
+            course_num,
+            throttle=throttle,
+        )
+
+    # Fetch lab files (only those changed since the last run)
+    lab_stream = stream_lab_files(
+        gh,
+        fname,
+        gid_list,
         lab_num,
         course_num,
-        save_dir=save_dir,
+        throttle=throttle,
+        num_workers=args.workers,
+        blob_cache=blob_cache,
+        manifest=manifest,
+        discovered=discovered,
+        session=session,
     )
+    # Useful in case something goes wrong.
+    if args.doSave is True:
+        lab_stream = archive.save_stream(
+            save_dir, lab_stream, args.archive, args.level
+        )
+    try:
+        key, exercises = next(iter(group_exercises.items()))
+        if len(group_exercises) == 1 and len(exercises) == 1:
+            # write each page as soon as its students are in
+            stream_pages_to_files(
+                lab_stream,
+                group_pages[key],
+                exercises[0],
+                lab_num,
+                course_num,
+                save_dir=save_dir,
+                pattern=args.pattern,
+                html_exporter=html_exporter,
+                num_jobs=args.jobs,
+                force=args.force,
+                assets=args.assets,
+                fragments=args.fragments,
+                label=key[0],
+                sizes=all_sizes.setdefault(
+                    roster.exercise_key(exercises[0]), {}
+                ),
+                render_cache=render_cache,
+            )
+        else:
+            # fetch every student once, then write each group's pages from
+            # the saved lab files
+            if args.doSave is True:
+                for _ in lab_stream:
+                    pass
+                lab_files = archive.map_files(save_dir, gid_list, args.archive)
+            else:
+                # (students whose lab file couldn't be fetched are None)
+                lab_files = {
+                    gid: lab for gid, lab in lab_stream if lab is not None
+                }
+            write_groups(lab_files)
+    finally:
+        cache.save_manifest(manifest_fname, manifest)
+        roster.save_sizes(sizes_fname, all_sizes)
+        if render_cache is not None:
+            render_cache.evict()
+    return
+
+
+def load_ghpw(uname):
+    if uname == "aberk":
+        with open("ghubcmds.pw", "r") as fp:
+            return fp.readline()
+    else:
+        raise ValueError(f"uname {uname} not recognized.")
+    return
+
+
+if __name__ == "__main__":
+    args = util.parser.parse_args()
+
+    if args.batch is not None:
+        # the job spec's settings replace the defaults of the flags (those
+        # passed on the command line still take precedence)
+        settings, outputs = batch.load_job(args.batch)
+        util.parser.set_defaults(**settings)
+        args = util.parser.parse_args()
+    else:
+        assert args.course is not None, f"Expected course_num but found None"
+        assert args.lab is not None, f"Expected lab_num but found None"
+        outputs = [batch.output_from_args(args)]
+
+    gh_uname = args.uname
+    throttle = args.throttle
+    num_workers = args.workers
+
+    # A token bucket shared across workers replaces the fixed sleep
+    if args.rate is not None:
+        throttle = ratelimit.TokenBucket(args.rate, args.burst)
+
+    assert gh_uname is not None, f"Expected gh_uname but found None"
+
+    # Time each stage (and count API calls) for a report at the end
+    report = timing.start() if args.report is not None else None
+
+    # Classy CSV should be the CSV file containing all of the github ids
+    class_roster = roster.Roster.from_csv(args.gidpath)
+
+    gh = None
+    session = None
+    if not args.offline:
+        # initialize github instance
+        password = load_ghpw(gh_uname)
+        base_url = "https://github.ubc.ca/api/v3"
+        pool_size = args.poolsize
+        if pool_size is None:
+            pool_size = max(num_workers, 1)
+        gh = Github(
+            login_or_token=gh_uname,
+            password=password,
+            base_url=base_url,
+            timeout=args.timeout,
+            pool_size=pool_size,
+        )
+        if args.adaptive:
+            # the quota is read from each response of the session below
+            base = throttle if args.rate is not None else None
+            throttle = ratelimit.AdaptiveThrottle(base=base)
+
+        # One pool of kept-alive connections, shared by every API call
+        session = ghapi.GitHubSession(
+            gh_uname,
+            password,
+            base_url,
+            gh,
+            pool_size=pool_size,
+            timeout=args.timeout,
+            throttle=throttle,
+        )
+
+    # Each lab is fetched once, for all of its outputs
+    for (course_num, lab_num), lab_outputs in batch.group_by_lab(
+        outputs
+    ).items():
+        run_lab(
+            course_num,
+            lab_num,
+            lab_outputs,
+            args,
+            class_roster,
+            gh,
+            session,
+            throttle,
+        )
+
+    if report is not None:
+        timing.stop()
+        report.print_summary()
+        report.write(args.report)
+        print(f"Wrote run report to {args.report}")